@@ -0,0 +1,8 @@
+"""
+WSGI-приложение только с админ-панелью и API бота
+Запуск: gunicorn -c gunicorn.conf.py -k sync -w 2 admin_wsgi:app
+Схему БД создает on_starting из gunicorn.conf.py один раз на мастер, а не каждый воркер при импорте
+"""
+from license_web_admin import create_app, admin_bp
+
+app = create_app(admin_bp)
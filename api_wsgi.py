@@ -0,0 +1,8 @@
+"""
+WSGI-приложение только с клиентским API (/api/v1/*) и /health
+Запуск: gunicorn -c gunicorn.conf.py api_wsgi:app
+Схему БД создает on_starting из gunicorn.conf.py один раз на мастер, а не каждый воркер при импорте
+"""
+from license_web_admin import create_app, api_bp
+
+app = create_app(api_bp)
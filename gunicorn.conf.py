@@ -0,0 +1,61 @@
+"""
+Конфигурация gunicorn для продакшена
+Запуск: gunicorn -c gunicorn.conf.py license_web_admin:app
+        (или python license_web_admin.py - процесс сам заменяется на gunicorn)
+Раздельно: gunicorn -c gunicorn.conf.py api_wsgi:app
+           gunicorn -c gunicorn.conf.py -k sync -w 2 admin_wsgi:app
+Схема БД создаётся в on_starting, до запуска воркеров, для любого из приложений.
+
+За nginx/балансировщиком задайте TRUSTED_PROXY_HOPS (число прокси перед gunicorn):
+лимит запросов клиентского API и бан за неверные подписи считаются по IP клиента,
+а без этой переменной gunicorn видит только адрес прокси, и лимиты по умолчанию
+выключены. Сервер без прокси включает их явно: CLIENT_RATE_LIMIT=10 BAD_SIGNATURE_LIMIT=20.
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+
+# gevent: heartbeat/check упираются в сеть и БД, поэтому тысячи соединений
+# обслуживаются кооперативно на одном event loop, без потока на каждый сокет
+# Без установленного gevent gunicorn не запустил бы ни одного воркера -
+# откатываемся на sync, чтобы сервис поднялся хотя бы без кооперативного режима
+if importlib.util.find_spec('gevent'):
+    worker_class = 'gevent'
+else:
+    worker_class = 'sync'
+    print("⚠️  gevent не установлен (pip install -r requirements_server.txt): sync-воркеры", file=sys.stderr)
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+
+# Клиенты шлют check/heartbeat по одному соединению (requests.Session): держим его
+# открытым между запросами, чтобы не платить TCP/TLS-рукопожатием за каждый опрос.
+# Для gevent-воркера простаивающее соединение стоит только сокета.
+keepalive = int(os.getenv('KEEPALIVE', '30'))
+
+
+def on_starting(server):
+    """init_database() один раз на мастер: license_web_admin:app сам схему не создаёт.
+
+    Вызов в отдельном процессе - импорт приложения в мастере оставил бы воркерам
+    унаследованные соединения пула и потоки, запущенные до monkey-patch gevent.
+    """
+    result = subprocess.run([
+        sys.executable, '-c',
+        'import sys, license_web_admin as m; sys.exit(0 if m.init_database() else 1)',
+    ], cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        server.log.error("Ошибка инициализации БД (код %s)", result.returncode)
+
+
+def post_fork(server, worker):
+    """psycopg2 - C-расширение: без patch_psycopg ожидание ответа БД блокирует весь воркер"""
+    if server.cfg.worker_class_str != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        server.log.warning("psycogreen не установлен: запросы к PostgreSQL будут блокировать gevent-воркер")
@@ -2,15 +2,30 @@
 Веб-интерфейс для управления лицензиями
 Админ-панель с генерацией ключей, просмотром устройств и управлением
 """
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session
+from flask import Flask, Blueprint, current_app, g, request, jsonify, redirect, url_for, session
+from jinja2 import Environment
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask.json.provider import DefaultJSONProvider
+import gzip
 import hashlib
+import hmac
 import json
 import os
 import logging
-from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+import threading
+import queue
+import time
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import Future
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import secrets
-from functools import wraps
+import shutil
+from functools import wraps, lru_cache
 
 # Загрузка переменных окружения из .env
 try:
@@ -22,14 +37,39 @@ except ImportError:
 # Проверка наличия psycopg2
 try:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import psycopg2.errors
+    import psycopg2.pool
+    from psycopg2.extras import Json, RealDictCursor, execute_batch, execute_values
     PSYCOPG2_AVAILABLE = True
 except ImportError:
     PSYCOPG2_AVAILABLE = False
 
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", secrets.token_hex(32))
-CORS(app)
+# orjson (C-расширение) в разы быстрее stdlib json; без него работаем на json
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Redis - необязательный общий кэш лицензий для всех процессов (включается REDIS_URL)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Клиентский API и админка - отдельные blueprint'ы: их можно обслуживать
+# разными процессами (api_wsgi.py / admin_wsgi.py), чтобы тяжелые запросы
+# админки не задерживали heartbeat и проверки лицензий
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+admin_bp = Blueprint('admin', __name__)
+
+# Число доверенных прокси перед приложением (Vercel - один). Только через них
+# X-Forwarded-For подменяет адрес клиента в request.remote_addr
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '1' if os.getenv('VERCEL') else '0'))
+
+# Общий для всех приложений, иначе сессия админки не переживет рестарт отдельного процесса
+FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY", secrets.token_hex(32))
 
 # Настройка логирования
 # На Vercel не используем FileHandler
@@ -40,21 +80,70 @@ if os.getenv('VERCEL'):
         handlers=[logging.StreamHandler()]
     )
 else:
+    # Запись в файл и консоль делает фоновый поток QueueListener: обработчик
+    # запроса только кладет запись в очередь и не ждет дискового ввода-вывода.
+    # На Vercel так не делаем - фоновые потоки там замораживаются между вызовами.
+    _log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    _log_handlers = [logging.FileHandler('license_api.log'), logging.StreamHandler()]
+    for _handler in _log_handlers:
+        _handler.setFormatter(_log_formatter)
+    _log_queue = queue.SimpleQueue()
+    _log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    _queue_handler = QueueHandler(_log_queue)
+    # Итоговый формат применяют обработчики слушателя, в очередь идет только текст сообщения
+    _queue_handler.setFormatter(logging.Formatter('%(message)s'))
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('license_api.log'),
-            logging.StreamHandler()
-        ]
+        handlers=[_queue_handler]
     )
 logger = logging.getLogger(__name__)
 
+class RateLimitFilter(logging.Filter):
+    """Ограничение частоты одинаковых предупреждений и ошибок.
+    
+    Для каждого шаблона сообщения - token bucket на rate записей в секунду
+    (с запасом burst). Поток одинаковых ошибок (например, при атаке плохими
+    запросами) не упирается в запись лога; число пропущенных записей
+    дописывается к следующей прошедшей. INFO и ниже не ограничиваются, как и
+    записи с extra={'no_ratelimit': True}.
+    """
+    
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def filter(self, record):
+        if record.levelno < logging.WARNING or getattr(record, 'no_ratelimit', False):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            # [токены, время последнего пополнения, пропущено записей]
+            bucket = self._buckets.setdefault(record.msg, [self.burst, now, 0])
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} (пропущено похожих записей: {suppressed})"
+        return True
+
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', '10'))
+logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT, burst=max(1, 2 * LOG_RATE_LIMIT)))
+
 # Секретный ключ из переменных окружения
 SECRET_KEY = os.getenv("LICENSE_SECRET_KEY", "eb3aad213730b203eef01da1d9bbbc0c63070a008c2fba734999622ad9981479")
 ADMIN_KEY = os.getenv("ADMIN_KEY", "CHANGE_THIS_ADMIN_KEY").strip()
 # Логируем при старте сервера (только длину для безопасности)
-logger.info(f"ADMIN_KEY загружен: длина={len(ADMIN_KEY)}, значение='{ADMIN_KEY[:10]}...' (первые 10 символов)")
+logger.info("ADMIN_KEY загружен: длина=%s, значение='%s...' (первые 10 символов)", len(ADMIN_KEY), ADMIN_KEY[:10])
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # Измените!
 
 # Whitelist IP для доступа к админ-панели
@@ -64,6 +153,8 @@ ADMIN_WHITELIST = os.getenv("ADMIN_WHITELIST", "").split(",") if os.getenv("ADMI
 # Если whitelist пуст и не на Vercel, разрешаем доступ с localhost
 if not ADMIN_WHITELIST and not os.getenv('VERCEL'):
     ADMIN_WHITELIST = ["127.0.0.1", "::1", "localhost"]
+# frozenset: проверка IP - одна проверка по хэшу вместо прохода по списку
+ADMIN_WHITELIST = frozenset(ip.strip() for ip in ADMIN_WHITELIST if ip.strip())
 
 # Настройки БД
 # Если есть POSTGRES_URL, DATABASE_URL или POSTGRES_PRISMA_URL, используем PostgreSQL
@@ -86,8 +177,61 @@ else:
         'password': os.getenv('POSTGRES_PASSWORD') or os.getenv('DB_PASSWORD', 'password')
     }
 
-def get_db_connection():
-    """Получение подключения к БД"""
+# Пул подключений: подключение берется на время запроса и возвращается обратно,
+# вместо connect/close (TCP+TLS+auth для PostgreSQL) на каждый запрос.
+# ThreadedConnectionPool держит открытыми не больше DB_POOL_MIN простаивающих подключений.
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1' if os.getenv('VERCEL') else '4'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '32'))
+# ThreadedConnectionPool не ждет свободного подключения, а сразу бросает PoolError.
+# Семафор на DB_POOL_MAX мест ставит лишние запросы в очередь (до DB_POOL_TIMEOUT
+# секунд): gevent-воркер держит до worker_connections запросов, а пул - 32 подключения
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+_db_pool = None
+_db_pool_slots = None
+_db_pool_lock = threading.Lock()
+
+# Prepared statements PostgreSQL живут в сессии; за pgbouncer в режиме transaction
+# сессия между запросами не сохраняется - там они выключены по умолчанию.
+# POSTGRES_URL / POSTGRES_PRISMA_URL на Vercel указывают как раз на такой пулер
+_BEHIND_POOLER = bool(os.getenv('VERCEL')) or any(
+    marker in (DATABASE_URL or '') for marker in ('pgbouncer', 'pooler', ':6543')
+)
+PG_PREPARED_STATEMENTS = os.getenv(
+    'PG_PREPARED_STATEMENTS', 'false' if _BEHIND_POOLER else 'true'
+).lower() == 'true'
+
+if PSYCOPG2_AVAILABLE:
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Подключение PostgreSQL, помнящее подготовленные в его сессии запросы"""
+        
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+    
+    class PooledConnection(PreparedConnection):
+        """Подключение пула обработчиков: autocommit.
+        
+        Обработчики выполняют по одному запросу на запись, и BEGIN + запрос + COMMIT
+        сводятся к одному сообщению серверу. Групповая запись идет через отдельные
+        подключения и остается транзакционной.
+        """
+        
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.autocommit = True
+
+# Настройки каждого подключения SQLite. В WAL synchronous=NORMAL не теряет целостность,
+# а fsync делается только на checkpoint; busy_timeout - ждать блокировку, а не падать
+SQLITE_PRAGMAS = (
+    'synchronous=NORMAL',
+    'busy_timeout=30000',
+    'temp_store=MEMORY',
+    'cache_size=-20000',
+    'mmap_size=268435456',
+)
+
+def _connect():
+    """Открытие нового подключения к БД"""
     if USE_SQLITE:
         # Используем SQLite
         import sqlite3
@@ -107,15 +251,18 @@ def get_db_connection():
                     # Fallback на временную директорию Python
                     import tempfile
                     db_path = os.path.join(tempfile.gettempdir(), 'licenses.db')
-                    logger.warning(f"Используем временную директорию: {db_path}")
+                    logger.warning("Используем временную директорию: %s", db_path)
             
-            conn = sqlite3.connect(db_path, timeout=10.0)
+            # cached_statements: повторные запросы берут уже скомпилированный statement из кэша
+            conn = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False, cached_statements=512)
             conn.row_factory = sqlite3.Row
-            # Включаем WAL режим для лучшей производительности
-            conn.execute('PRAGMA journal_mode=WAL;')
+            # WAL включается один раз в init_database и хранится в самом файле БД,
+            # здесь только настройки уровня подключения
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(f'PRAGMA {pragma};')
             return conn
         except Exception as e:
-            logger.error(f"Ошибка подключения к SQLite: {e}, путь: {db_path}")
+            logger.error("Ошибка подключения к SQLite: %s, путь: %s", e, db_path)
             # Пробуем in-memory БД как последний вариант (данные не сохранятся!)
             logger.warning("Пробуем in-memory БД (данные не сохранятся между запросами!)")
             try:
@@ -123,7 +270,7 @@ def get_db_connection():
                 conn.row_factory = sqlite3.Row
                 return conn
             except Exception as e2:
-                logger.error(f"Ошибка создания in-memory БД: {e2}")
+                logger.error("Ошибка создания in-memory БД: %s", e2)
                 return None
     else:
         # Используем PostgreSQL
@@ -133,47 +280,911 @@ def get_db_connection():
         try:
             # Если есть строка подключения, используем её
             if 'dsn' in DB_CONFIG:
-                conn = psycopg2.connect(DB_CONFIG['dsn'])
+                conn = psycopg2.connect(DB_CONFIG['dsn'], connection_factory=PreparedConnection)
             else:
-                conn = psycopg2.connect(**DB_CONFIG)
+                conn = psycopg2.connect(connection_factory=PreparedConnection, **DB_CONFIG)
             return conn
         except Exception as e:
-            logger.error(f"Ошибка подключения к PostgreSQL: {e}")
-            logger.error(f"Конфигурация: {'dsn=***' if 'dsn' in DB_CONFIG else DB_CONFIG}")
+            logger.error("Ошибка подключения к PostgreSQL: %s", e)
+            logger.error("Конфигурация: %s", 'dsn=***' if 'dsn' in DB_CONFIG else DB_CONFIG)
             return None
 
-def get_cursor(conn):
-    """Получение курсора с правильным типом"""
+def _get_pool():
+    """Пул создается лениво, чтобы после fork у каждого процесса был свой"""
+    global _db_pool, _db_pool_slots
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                if USE_SQLITE:
+                    _db_pool = queue.LifoQueue(maxsize=DB_POOL_MAX)
+                else:
+                    # Семафор создается здесь же, уже после monkey-patch gevent в воркере
+                    _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                    _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                        DB_POOL_MIN, DB_POOL_MAX, connection_factory=PooledConnection, **DB_CONFIG
+                    )
+    return _db_pool
+
+def get_db_connection():
+    """Получение подключения к БД из пула"""
+    if USE_SQLITE:
+        try:
+            return _get_pool().get_nowait()
+        except queue.Empty:
+            return _connect()
+    if not PSYCOPG2_AVAILABLE:
+        logger.error("psycopg2 не установлен. Используйте: pip install psycopg2-binary")
+        return None
+    pool = _get_pool()
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        logger.error("Нет свободного подключения в пуле за %s с (DB_POOL_MAX=%d)", DB_POOL_TIMEOUT, DB_POOL_MAX)
+        return None
+    try:
+        conn = pool.getconn()
+    except Exception as e:
+        _db_pool_slots.release()
+        logger.error("Ошибка подключения к PostgreSQL: %s", e)
+        logger.error("Конфигурация: %s", 'dsn=***' if 'dsn' in DB_CONFIG else DB_CONFIG)
+        return None
+    # Пояс читаем на уже взятом подключении: db_timestamp() внутри db_cursor
+    # не должен занимать второе подключение пула
+    if _db_timezone is None or _db_timezone_retry:
+        _read_db_timezone(conn)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    """Возврат подключения в пул (broken=True - оборванное подключение PostgreSQL закрывается)"""
     if USE_SQLITE:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _get_pool().put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    else:
+        # putconn сам откатывает незавершенную транзакцию. Оборванное подключение
+        # (рестарт PostgreSQL, таймаут простоя) в пул не возвращаем, иначе
+        # следующий запрос получит его и упадет
+        try:
+            _get_pool().putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            _db_pool_slots.release()
+
+_db_timezone = None
+# UTC взят временно (БД была недоступна): следующее подключение из пула перечитает пояс
+_db_timezone_retry = False
+
+def _read_db_timezone(conn):
+    """Часовой пояс сессий PostgreSQL (SHOW TimeZone) на переданном подключении"""
+    global _db_timezone, _db_timezone_retry
+    name = None
+    try:
+        cur = conn.cursor()
+        cur.execute("SHOW TimeZone")
+        name = cur.fetchone()[0]
+        cur.close()
+        _db_timezone, _db_timezone_retry = ZoneInfo(name), False
+    except DB_CONNECTION_ERRORS:
+        # Ошибку оборванного подключения получит сам запрос
+        _db_timezone, _db_timezone_retry = timezone.utc, True
+    except Exception as e:
+        logger.warning("Часовой пояс БД %r не распознан, время пишется в UTC: %s", name, e)
+        _db_timezone, _db_timezone_retry = timezone.utc, False
+
+def _get_db_timezone():
+    """Часовой пояс сессий PostgreSQL, читается один раз на процесс.
+    
+    Обычно уже прочитан первым get_db_connection. Без подключения к БД - UTC,
+    который тоже запоминается, чтобы каждый запрос не ждал пул заново.
+    """
+    global _db_timezone, _db_timezone_retry
+    if _db_timezone is None:
+        conn = get_db_connection()
+        if conn:
+            release_db_connection(conn)
+        if _db_timezone is None:
+            logger.warning("Нет подключения к БД: время пишется в UTC до следующего подключения")
+            _db_timezone, _db_timezone_retry = timezone.utc, True
+    return _db_timezone
+
+def close_db_pool():
+    """Закрытие всех подключений пула (при завершении процесса)"""
+    global _db_pool
+    with _db_pool_lock:
+        pool, _db_pool = _db_pool, None
+    if pool is None:
+        return
+    if USE_SQLITE:
+        # Закрытие последнего подключения к SQLite делает checkpoint WAL в основной файл
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+    else:
+        pool.closeall()
+
+atexit.register(close_db_pool)
+
+# Ошибки, после которых подключение к PostgreSQL считается потерянным.
+# Файловое подключение SQLite оборваться не может
+if PSYCOPG2_AVAILABLE and not USE_SQLITE:
+    DB_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+else:
+    DB_CONNECTION_ERRORS = ()
+
+@contextmanager
+def db_cursor(as_dict=True):
+    """Курсор на подключении из пула (as_dict=False - строки-кортежи).
+    
+    При нормальном выходе из блока транзакция фиксируется, при исключении
+    откатывается; подключение в любом случае возвращается в пул. В PostgreSQL
+    подключения пула работают в autocommit - каждый запрос фиксируется сразу,
+    поэтому несколько записей, которые должны пройти вместе, в один блок не кладем.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise ConnectionError("Ошибка подключения к БД")
+    cur = get_cursor(conn, as_dict)
+    broken = False
+    try:
+        yield cur
+        conn.commit()
+    except DB_CONNECTION_ERRORS:
+        broken = True
+        raise
+    finally:
+        try:
+            cur.close()
+        except DB_CONNECTION_ERRORS:
+            broken = True
+        release_db_connection(conn, broken)
+
+def get_cursor(conn, as_dict=True):
+    """Получение курсора с правильным типом (as_dict=False - строки-кортежи)"""
+    if USE_SQLITE:
+        cur = conn.cursor()
+        if not as_dict:
+            # Перекрывает sqlite3.Row подключения только для этого курсора
+            cur.row_factory = None
+        return cur
+    elif not as_dict:
         return conn.cursor()
     else:
-        from psycopg2.extras import RealDictCursor
         return conn.cursor(cursor_factory=RealDictCursor)
 
+def fetch_dicts(cur):
+    """Строки курсора-кортежей как список dict: один dict на строку, без Row/RealDictRow"""
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+@lru_cache(maxsize=256)
+def _to_sqlite(query):
+    """Запрос с плейсхолдерами SQLite: ? вместо %s (результат запоминается для каждого текста)"""
+    return query.replace('%s', '?')
+
 def execute_query(cur, query, params=None):
     """Универсальное выполнение запроса для SQLite и PostgreSQL"""
     if USE_SQLITE:
-        # SQLite использует ? вместо %s
-        if params:
-            # Конвертируем %s в ? для SQLite
-            query = query.replace('%s', '?')
-        cur.execute(query, params)
+        # SQLite использует ? вместо %s; запросы-константы уже в этом виде
+        cur.execute(_to_sqlite(query), params or ())
     else:
         # PostgreSQL использует %s
         cur.execute(query, params)
 
+# Горячие запросы клиентского API. В PostgreSQL каждый готовится (PREPARE) один раз
+# на подключение и дальше выполняется через EXECUTE без повторного разбора и планирования
+PREPARED_QUERIES = {
+    'lic_get': "SELECT status, expires_at, device_id FROM licenses WHERE key = %s",
+    'lic_activate': """
+        UPDATE licenses 
+        SET device_id = %s, device_info = %s, activated_at = %s, status = 'active'
+        WHERE key = %s AND status <> 'blocked'
+          AND (device_id IS NULL OR device_id = %s)
+          AND (expires_at IS NULL OR expires_at > %s)
+    """,
+    # Свежую отметку не перезаписываем: без этого каждый heartbeat - новая версия
+    # строки и запись в WAL, даже если другой процесс только что ее обновил
+    'hb_update': """
+        UPDATE licenses SET heartbeat_last = %s
+        WHERE key = %s AND device_id = %s
+          AND (heartbeat_last IS NULL OR heartbeat_last < %s)
+    """,
+    'lic_touch': "UPDATE licenses SET last_check = %s WHERE key = %s",
+    # Смена статуса истекшего ключа. Срок еще раз проверяет сама БД: если его продлили
+    # после чтения строки, UPDATE ничего не изменит (rowcount = 0)
+    'lic_expire': "UPDATE licenses SET status = %s WHERE key = %s AND expires_at <= %s",
+    # Блокировка клиентом: только если ключ не привязан к другому устройству
+    'lic_deactivate': """
+        UPDATE licenses SET status = 'blocked'
+        WHERE key = %s AND (device_id IS NULL OR device_id = %s)
+    """,
+    'lic_insert': "INSERT INTO licenses (key, expires_at, status) VALUES (%s, %s, 'active')",
+    'lic_set_status': "UPDATE licenses SET status = %s WHERE key = %s",
+}
+
+def prepared_query(cur, name):
+    """Текст для выполнения запроса name: EXECUTE в PostgreSQL, сам запрос в SQLite"""
+    query = PREPARED_QUERIES[name]
+    prepared = getattr(cur.connection, 'prepared', None)
+    if USE_SQLITE or not PG_PREPARED_STATEMENTS or prepared is None:
+        return query
+    parts = query.split('%s')
+    if name not in prepared:
+        # PREPARE не транзакционный: откат текущей транзакции его не отменяет
+        numbered = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+        cur.execute(f"PREPARE {name} AS {numbered}")
+        prepared.add(name)
+    return f"EXECUTE {name} ({', '.join(['%s'] * (len(parts) - 1))})"
+
+# Запрос не подготовлен в текущей серверной сессии (без psycopg2 - ничего не ловим)
+PREPARED_STATEMENT_ERRORS = (psycopg2.errors.InvalidSqlStatementName,) if PSYCOPG2_AVAILABLE else ()
+
+def execute_prepared(cur, name, params):
+    """Выполнение запроса из PREPARED_QUERIES"""
+    try:
+        execute_query(cur, prepared_query(cur, name), params)
+    except PREPARED_STATEMENT_ERRORS:
+        # Пулер отдал другую серверную сессию, где запрос не подготовлен. В autocommit
+        # ошибка не ломает транзакцию - забываем подготовленные запросы и повторяем;
+        # в транзакции повтор невозможен, ошибка уходит вызывающему
+        if not cur.connection.autocommit:
+            raise
+        cur.connection.prepared.clear()
+        execute_query(cur, prepared_query(cur, name), params)
+
+def _sql(query):
+    """Запрос с плейсхолдерами текущей БД (подставляется один раз при загрузке модуля)"""
+    return _to_sqlite(query) if USE_SQLITE else query
+
+# Запросы админки и бота: выбор диалекта сделан при импорте, в обработчиках ветвлений нет
+SQL_LIST_LICENSES = "SELECT * FROM licenses ORDER BY created_at DESC"
+
+def _iso_column(column):
+    """Колонка времени, уже отформатированная БД в строку ISO 8601"""
+    if USE_SQLITE:
+        return f"strftime('%Y-%m-%dT%H:%M:%S', {column}) AS {column}"
+    return f"to_char({column}, 'YYYY-MM-DD\"T\"HH24:MI:SS') AS {column}"
+
+# Список для админки: только нужные таблице колонки, даты и device_info
+# приходят из БД готовыми строками и отдаются в JSON без обработки в Python
+_ADMIN_LICENSE_COLUMNS = f"""
+    key, status, device_id, {'device_info' if USE_SQLITE else 'device_info::text AS device_info'},
+    {_iso_column('created_at')}, {_iso_column('activated_at')}, {_iso_column('expires_at')}
+"""
+SQL_LIST_LICENSES_ADMIN = _sql(f"""
+    SELECT {_ADMIN_LICENSE_COLUMNS} FROM licenses
+    ORDER BY licenses.created_at DESC LIMIT %s OFFSET %s
+""")
+# Поиск по началу ключа - диапазонное чтение индекса по key. В SQLite LIKE
+# регистронезависим и индекс не использует, а GLOB с префиксом использует
+KEY_PREFIX_WILDCARD = '*' if USE_SQLITE else '%'
+_KEY_PREFIX_FILTER = f"WHERE key {'GLOB' if USE_SQLITE else 'LIKE'} %s"
+SQL_SEARCH_LICENSES_ADMIN = _sql(f"""
+    SELECT {_ADMIN_LICENSE_COLUMNS} FROM licenses {_KEY_PREFIX_FILTER}
+    ORDER BY licenses.created_at DESC LIMIT %s OFFSET %s
+""")
+# Счетчики для карточек статистики считает БД: страница содержит только часть ключей
+_LICENSE_STATS_COLUMNS = """
+    COUNT(*) AS total,
+    SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END) AS active,
+    SUM(CASE WHEN status = 'blocked' THEN 1 ELSE 0 END) AS blocked,
+    SUM(CASE WHEN status = 'expired' THEN 1 ELSE 0 END) AS expired,
+    SUM(CASE WHEN device_id IS NOT NULL THEN 1 ELSE 0 END) AS activated
+"""
+SQL_LICENSE_STATS = f"SELECT {_LICENSE_STATS_COLUMNS} FROM licenses"
+SQL_SEARCH_LICENSE_STATS = _sql(f"SELECT {_LICENSE_STATS_COLUMNS} FROM licenses {_KEY_PREFIX_FILTER}")
+ADMIN_PAGE_SIZE = 100
+ADMIN_PAGE_SIZE_MAX = 500
+SQL_UNBIND_LICENSE = _sql("UPDATE licenses SET device_id = NULL, device_info = NULL, activated_at = NULL WHERE key = %s")
+SQL_DELETE_LICENSE = _sql("DELETE FROM licenses WHERE key = %s")
+# Пакетная активация в PostgreSQL: условия те же, что у lic_activate, но одним
+# UPDATE на весь пакет; RETURNING - ключи, которые удалось активировать
+SQL_ACTIVATE_BATCH_PG = """
+    UPDATE licenses
+    SET device_id = v.device_id, device_info = v.device_info::jsonb,
+        activated_at = v.activated_at, status = 'active'
+    FROM (VALUES %s) AS v(key, device_id, device_info, activated_at, now)
+    WHERE licenses.key = v.key AND licenses.status <> 'blocked'
+      AND (licenses.device_id IS NULL OR licenses.device_id = v.device_id)
+      AND (licenses.expires_at IS NULL OR licenses.expires_at > v.now)
+    RETURNING licenses.key
+"""
+ACTIVATE_BATCH_MAX = 100
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением времени жизни записей"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def add(self, key, value):
+        """Запись значения, только если ключа нет; True если запись добавлена"""
+        with self._lock:
+            if self.get(key) is not None:
+                return False
+            self.set(key, value)
+            return True
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+    
+    def incr(self, key):
+        """Увеличение счетчика (отсутствующий - с нуля, TTL отсчитывается заново); новое значение"""
+        with self._lock:
+            value = self.get(key, 0) + 1
+            self.set(key, value)
+            return value
+
+class RateLimiter:
+    """Token bucket на клиента: rate запросов в секунду с запасом burst.
+    
+    Хранятся не больше maxsize клиентов - давно не приходившие вытесняются
+    (их корзина к тому времени все равно была бы полной).
+    """
+    
+    def __init__(self, rate, burst, maxsize=100_000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def allow(self, client):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                # [токены, время последнего пополнения]
+                bucket = self._buckets[client] = [self.burst, now]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+class SingleFlight:
+    """Схлопывание одновременных загрузок одного ключа.
+    
+    Первый вызов do() для ключа выполняет загрузку, вызовы, пришедшие до ее
+    окончания, получают тот же результат (или то же исключение).
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def do(self, key, load):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = load()
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        call.set_result(result)
+        return result
+
+_license_loads = SingleFlight()
+
+# Кэш строк лицензий: лицензии меняются редко, а читаются на каждый запрос клиента.
+# Любая запись в лицензию из этого процесса сбрасывает ее запись в кэше; другие
+# процессы видят изменение только после истечения TTL их локального кэша.
+# С Redis локальный TTL короткий: общий кэш сбрасывается сразу, и отставание
+# других процессов ограничено парой секунд
+LICENSE_CACHE_TTL = int(os.getenv(
+    'LICENSE_CACHE_TTL', '2' if os.getenv('REDIS_URL') and REDIS_AVAILABLE else '30'
+))
+LICENSE_CACHE = TTLCache(maxsize=4096, ttl=LICENSE_CACHE_TTL)
+
+# Второй уровень кэша в Redis: общий для всех воркеров и серверов, поэтому промах
+# локального кэша в одном процессе не превращается в запрос к БД. Сброс ключа
+# удаляет его из Redis сразу, но локальные кэши других процессов держат старую
+# запись до LICENSE_CACHE_TTL (с Redis - 2 с по умолчанию)
+REDIS_URL = os.getenv('REDIS_URL')
+REDIS_LICENSE_TTL = int(os.getenv('REDIS_LICENSE_TTL', '60'))
+# После ошибки Redis не опрашивается REDIS_RETRY_INTERVAL секунд - запросы идут в БД
+REDIS_RETRY_INTERVAL = 5
+_redis = None
+_redis_retry_at = 0.0
+
+if REDIS_URL:
+    if REDIS_AVAILABLE:
+        # Короткие таймауты: медленный Redis не должен тормозить проверку ключа
+        _redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2)
+    else:
+        logger.warning("REDIS_URL задан, но redis не установлен. Используйте: pip install redis")
+
+def _redis_call(method, *args):
+    """Вызов Redis; None если Redis не настроен или недоступен"""
+    global _redis_retry_at
+    if _redis is None or time.monotonic() < _redis_retry_at:
+        return None
+    try:
+        return getattr(_redis, method)(*args)
+    except redis.RedisError as e:
+        _redis_retry_at = time.monotonic() + REDIS_RETRY_INTERVAL
+        logger.warning("Redis недоступен, кэш отключен на %d с: %s", REDIS_RETRY_INTERVAL, e)
+        return None
+
+def _redis_license_key(key):
+    # Версия в префиксе меняется вместе с набором полей записи: после обновления
+    # процессы не читают записи старого формата, оставленные предыдущей версией
+    return 'lic:v2:' + key
+
+def _redis_generation_key(key):
+    return 'lic:gen:' + key
+
+# Поколение ключа растет при каждом сбросе. Строка, прочитанная из БД до записи,
+# может дойти до кэша уже после сброса и держала бы старый статус (например,
+# активный у только что заблокированного ключа) весь TTL. Поэтому кэш заполняется,
+# только если поколение не менялось с начала чтения. Счетчики живут дольше любого
+# чтения из БД
+LICENSE_GENERATION_TTL = 300
+_license_generations = TTLCache(maxsize=100_000, ttl=LICENSE_GENERATION_TTL)
+
+# Проверка поколения и запись - один атомарный шаг на стороне Redis
+_REDIS_SET_IF_GENERATION = """
+if (redis.call('get', KEYS[2]) or '0') == ARGV[1] then
+    redis.call('setex', KEYS[1], ARGV[2], ARGV[3])
+end
+"""
+_REDIS_INVALIDATE = """
+redis.call('del', KEYS[1])
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[1])
+"""
+
+def to_datetime(value):
+    """Дата из БД: SQLite отдает строку ISO, PostgreSQL - datetime"""
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def get_license(key, cur=None):
+    """Статус, срок и устройство лицензии (с кэшем); None если ключа нет"""
+    license_info = LICENSE_CACHE.get(key)
+    if license_info is not None:
+        return license_info
+    # Одновременные промахи по одному ключу (например, все клиенты перезапустились
+    # разом) дают одно чтение из Redis/БД, остальные запросы ждут его результат
+    return _license_loads.do(key, lambda: _load_license(key, cur))
+
+def _load_license(key, cur):
+    """Чтение лицензии мимо локального кэша: из Redis, затем из БД"""
+    # Поколения берутся до чтения - см. LICENSE_GENERATION_TTL
+    generation = _license_generations.get(key, 0)
+    redis_generation = None
+    if _redis is not None:
+        cached = _redis_call('mget', [_redis_license_key(key), _redis_generation_key(key)])
+        if cached:
+            raw, redis_generation = cached
+            if raw:
+                license_info = json_loads(raw)
+                _cache_license_locally(key, license_info, generation)
+                return license_info
+            redis_generation = redis_generation or b'0'
+    
+    if cur is None:
+        with db_cursor() as cur:
+            return _fetch_license(key, cur, generation, redis_generation)
+    return _fetch_license(key, cur, generation, redis_generation)
+
+def _cache_license_locally(key, license_info, generation):
+    """Запись в локальный кэш, если ключ не сбрасывали с начала чтения.
+    
+    Проверка идет после записи: сброс между ними увидит и удалит уже записанное.
+    """
+    LICENSE_CACHE.set(key, license_info)
+    if _license_generations.get(key, 0) != generation:
+        LICENSE_CACHE.pop(key, None)
+
+def _fetch_license(key, cur, generation, redis_generation):
+    """Чтение лицензии из БД с заполнением кэшей"""
+    # Три поля читаем кортежем: без построения Row/RealDictRow на каждую строку
+    tuple_cur = get_cursor(cur.connection, as_dict=False)
+    try:
+        execute_prepared(tuple_cur, 'lic_get', (key,))
+        row = tuple_cur.fetchone()
+    finally:
+        tuple_cur.close()
+    if not row:
+        return None
+    status, expires_at, device_id = row
+    
+    # Срок разбирается один раз при чтении из БД: expires_ts (epoch) для проверки
+    # истечения одним сравнением чисел и expires_at строкой ISO для ответа клиенту -
+    # одинаково для SQLite и PostgreSQL
+    expires = to_datetime(expires_at)
+    license_info = {
+        'status': status,
+        'expires_at': expires.isoformat() if expires else None,
+        'device_id': device_id,
+        'expires_ts': expires.timestamp() if expires else None,
+    }
+    # ETag ответа check_license: меняется вместе с любым из полей лицензии
+    license_info['etag'] = hashlib.blake2b(
+        f"{status}|{license_info['expires_at']}|{device_id}".encode(), digest_size=8
+    ).hexdigest()
+    
+    # Лицензию, истекающую в пределах TTL, не кэшируем, чтобы не пропустить момент истечения
+    if not expires or license_info['expires_ts'] - time.time() > LICENSE_CACHE_TTL:
+        _cache_license_locally(key, license_info, generation)
+    # redis_generation None - Redis не настроен или не ответил на чтение
+    if redis_generation is not None and (not expires or license_info['expires_ts'] - time.time() > REDIS_LICENSE_TTL):
+        _redis_call(
+            'eval', _REDIS_SET_IF_GENERATION, 2,
+            _redis_license_key(key), _redis_generation_key(key),
+            redis_generation, REDIS_LICENSE_TTL, json_dumps(license_info),
+        )
+    return license_info
+
+def invalidate_license(key):
+    """Сброс лицензии из кэша после изменения (локального и общего в Redis)"""
+    _license_generations.incr(key)
+    LICENSE_CACHE.pop(key, None)
+    if _redis is not None:
+        _redis_call(
+            'eval', _REDIS_INVALIDATE, 2,
+            _redis_license_key(key), _redis_generation_key(key), LICENSE_GENERATION_TTL,
+        )
+
+def json_dumps(obj):
+    """Сериализация в JSON-строку"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def json_loads(raw):
+    """Разбор JSON из строки или байтов"""
+    return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+
+def load_json_body(loads=json_loads):
+    """Тело запроса как JSON; None если тело пустое или не разбирается"""
+    raw = request.get_data()
+    if not raw:
+        return None
+    try:
+        return loads(raw)
+    except ValueError:
+        return None
+
+def json_response(body, status=200):
+    """Ответ из заранее сериализованного JSON.
+    
+    Общий объект Response отдавать нельзя: after_request-обработчики (CORS)
+    дописывают в него заголовки, поэтому каждый раз создается новый.
+    """
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+def server_error(result_field, log_message, error):
+    """Ответ 500 без подробностей исключения.
+    
+    Текст ошибки остается в логе, клиент получает только короткий код,
+    по которому запись в логе легко найти.
+    """
+    error_id = secrets.token_hex(4)
+    # Клиенту обещан код для поиска в логе - такие записи фильтр частоты не отбрасывает
+    logger.error(log_message + " [%s]: %s", error_id, error, extra={'no_ratelimit': True})
+    return jsonify({
+        result_field: False,
+        "message": f"Ошибка сервера (код {error_id})",
+        "error_id": error_id,
+    }), 500
+
+def db_json(value):
+    """Значение для колонки device_info: строка JSON в SQLite, адаптер jsonb в PostgreSQL.
+    
+    Json сериализует через json_dumps (orjson), а не через stdlib json по умолчанию.
+    """
+    if USE_SQLITE:
+        return json_dumps(value)
+    return Json(value, dumps=json_dumps)
+
+def db_datetime(value):
+    """Локальное время в формате колонок expires_at: строка ISO в SQLite, datetime в PostgreSQL"""
+    if value is None or not USE_SQLITE:
+        return value
+    return value.isoformat()
+
+def db_timestamp(seconds_ago=0):
+    """Текущее время (минус seconds_ago) в том же виде, что пишет CURRENT_TIMESTAMP колонки.
+    
+    SQLite хранит UTC. PostgreSQL пишет в TIMESTAMP без пояса время часового пояса
+    сессии (TimeZone сервера) - в нем же считаем и мы, чтобы не смешивать с
+    created_at. Время передается в запросы параметром, а не вычисляется в SQL:
+    так одинаковые записи можно группировать и схлопывать до выполнения.
+    """
+    tz = timezone.utc if USE_SQLITE else _get_db_timezone()
+    now = datetime.now(tz).replace(tzinfo=None, microsecond=0)
+    if seconds_ago:
+        now -= timedelta(seconds=seconds_ago)
+    return now.isoformat(sep=' ') if USE_SQLITE else now
+
+# Дополнительные настройки выделенного подключения SQLite для групповой записи
+WRITER_SQLITE_PRAGMAS = (
+    'cache_size=-65536',
+    'busy_timeout=5000',
+)
+
+class GroupCommitter:
+    """Групповая запись: строки копятся в памяти и пишутся одной транзакцией.
+    
+    Фоновый поток сбрасывает накопленное раз в interval секунд или сразу,
+    как только набралось max_pending строк - один fsync на пачку вместо
+    одного на запрос. Строки с одинаковым dedup_key внутри окна схлопываются,
+    остается последняя. statement - имя запроса из PREPARED_QUERIES.
+    values_query - необязательный вариант для PostgreSQL: один UPDATE ... FROM
+    (VALUES %s) на всю пачку через execute_values.
+    
+    add() не ждет записи; submit() ждет commit пачки, в которую попала строка.
+    """
+    
+    def __init__(self, name, statement, interval, max_pending, values_query=None):
+        self.name = name
+        self.statement = statement
+        self.values_query = values_query
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # Очередь непуста: без нее поток спит без таймаута, а не просыпается каждые interval
+        self._has_pending = threading.Event()
+        self._thread = None
+        self._conn = None
+    
+    def add(self, dedup_key, params):
+        """Постановка строки в очередь на запись"""
+        if os.getenv('VERCEL'):
+            # На Vercel фоновые потоки замораживаются между вызовами - пишем сразу
+            with self._write_lock:
+                self._write([params])
+            return
+        with self._lock:
+            self._enqueue(dedup_key, params)
+    
+    def submit(self, dedup_key, params, timeout=30):
+        """Запись строки с ожиданием commit; при ошибке записи бросает исключение"""
+        if os.getenv('VERCEL'):
+            with self._write_lock:
+                error = self._write([params])
+        else:
+            done = Future()
+            with self._lock:
+                self._waiters.append(done)
+                self._enqueue(dedup_key, params)
+            error = done.result(timeout)
+        if error:
+            raise error
+    
+    def _enqueue(self, dedup_key, params):
+        if not self._pending:
+            self._has_pending.set()
+        self._pending[dedup_key] = params
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+        # Поток запускаем лениво: после fork (gunicorn) его нужно поднять заново
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f'{self.name}-writer', daemon=True)
+            self._thread.start()
+    
+    def flush(self):
+        """Сброс накопленного в БД"""
+        # Пачки пишутся строго в порядке формирования: снимок очереди берется под _write_lock
+        with self._write_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, {}
+                waiters, self._waiters = self._waiters, []
+            error = self._write(list(pending.values()))
+        for done in waiters:
+            done.set_result(error)
+    
+    def _run(self):
+        while True:
+            # Окно interval отсчитывается от первой строки пачки
+            self._has_pending.wait()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._has_pending.clear()
+            self.flush()
+    
+    def _write(self, batch):
+        """Запись пачки через выделенное подключение (под _write_lock); ошибка или None"""
+        if self._conn is None:
+            self._conn = _connect()
+            if not self._conn:
+                logger.error("Нет подключения к БД, потеряно записей %s: %d", self.name, len(batch))
+                return ConnectionError("Ошибка подключения к БД")
+            if USE_SQLITE:
+                for pragma in WRITER_SQLITE_PRAGMAS:
+                    self._conn.execute(f'PRAGMA {pragma};')
+        try:
+            cur = self._conn.cursor()
+            # with conn - одна транзакция на всю пачку (commit или rollback)
+            with self._conn:
+                if USE_SQLITE:
+                    cur.executemany(_to_sqlite(PREPARED_QUERIES[self.statement]), batch)
+                elif self.values_query:
+                    execute_values(cur, self.values_query, batch, page_size=1000)
+                else:
+                    query = prepared_query(cur, self.statement)
+                    # executemany в psycopg2 - отдельный round-trip на каждую строку;
+                    # execute_batch склеивает EXECUTE в один запрос на page_size строк
+                    execute_batch(cur, query, batch, page_size=100)
+            cur.close()
+            return None
+        except Exception as e:
+            logger.error("Ошибка записи %s (%d шт.): %s", self.name, len(batch), e)
+            try:
+                self._conn.close()
+            except:
+                pass
+            self._conn = None
+            return e
+
+# Heartbeat: обработчик только ставит запись в очередь, в БД ее пишет GroupCommitter
+HEARTBEAT_FLUSH_INTERVAL = float(os.getenv('HEARTBEAT_FLUSH_INTERVAL', '0.005'))
+HEARTBEAT_WRITER = GroupCommitter(
+    'heartbeat',
+    'hb_update',
+    interval=HEARTBEAT_FLUSH_INTERVAL,
+    max_pending=256,
+    values_query="""
+        UPDATE licenses SET heartbeat_last = v.ts
+        FROM (VALUES %s) AS v(ts, key, device_id, fresh_after)
+        WHERE licenses.key = v.key AND licenses.device_id = v.device_id
+          AND (licenses.heartbeat_last IS NULL OR licenses.heartbeat_last < v.fresh_after)
+    """,
+)
+
+# Heartbeat одного устройства чаще HEARTBEAT_MIN_INTERVAL секунд в БД не пишем:
+# ответ клиенту тот же, а нагрузка на запись ограничена независимо от поведения клиента
+HEARTBEAT_MIN_INTERVAL = int(os.getenv('HEARTBEAT_MIN_INTERVAL', '15'))
+_recent_heartbeats = TTLCache(maxsize=200_000, ttl=HEARTBEAT_MIN_INTERVAL)
+
+# last_check - отметка для админки, точность до секунд ей не нужна. Проверки одного
+# ключа за окно схлопываются в одну строку, окно пишется одним UPDATE: без записи
+# и commit на каждую проверку (и без мертвых версий строк в PostgreSQL)
+LAST_CHECK_FLUSH_INTERVAL = float(os.getenv('LAST_CHECK_FLUSH_INTERVAL', '5'))
+LAST_CHECK_WRITER = GroupCommitter(
+    'last-check',
+    'lic_touch',
+    interval=LAST_CHECK_FLUSH_INTERVAL,
+    max_pending=4096,
+    values_query="""
+        UPDATE licenses SET last_check = v.ts
+        FROM (VALUES %s) AS v(ts, key)
+        WHERE licenses.key = v.key
+    """,
+)
+
+def queue_heartbeat(key, device_id):
+    """Постановка heartbeat в очередь на запись"""
+    if not _recent_heartbeats.add((key, device_id), True):
+        return
+    HEARTBEAT_WRITER.add(
+        (key, device_id),
+        (db_timestamp(), key, device_id, db_timestamp(HEARTBEAT_MIN_INTERVAL)),
+    )
+
+# Запись новых ключей и смена статуса из админки и бота. Обработчик ждет commit
+# (ключ сразу виден в списке, ошибка записи возвращается админу), но одновременные
+# запросы попадают в одну транзакцию вместо очереди за блокировкой записи SQLite
+ADMIN_FLUSH_INTERVAL = float(os.getenv('ADMIN_FLUSH_INTERVAL', '0.05'))
+LICENSE_INSERT_WRITER = GroupCommitter('license-insert', 'lic_insert', interval=ADMIN_FLUSH_INTERVAL, max_pending=256)
+LICENSE_STATUS_WRITER = GroupCommitter('license-status', 'lic_set_status', interval=ADMIN_FLUSH_INTERVAL, max_pending=256)
+
+def flush_pending_writes():
+    """Сброс всех отложенных записей (вызывается и при завершении процесса)"""
+    for writer in (HEARTBEAT_WRITER, LAST_CHECK_WRITER, LICENSE_INSERT_WRITER, LICENSE_STATUS_WRITER):
+        writer.flush()
+
+atexit.register(flush_pending_writes)
+
+def _migrate_pg_indexes(cur):
+    """Индексы licenses в PostgreSQL: недостающие создаются один раз.
+    
+    DDL блокирует самую нагруженную таблицу (CREATE INDEX - SHARE, DROP CONSTRAINT -
+    ACCESS EXCLUSIVE), поэтому сначала читаем каталог и выполняем только недостающие
+    шаги: на готовой схеме старт процесса не трогает licenses.
+    """
+    cur.execute("""
+        SELECT c.relname AS name, i.indisunique AND i.indisvalid AS unique_valid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = 'licenses'::regclass
+    """)
+    indexes = {row['name']: row['unique_valid'] for row in cur.fetchall()}
+    cur.execute("""
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'licenses'::regclass AND conname = 'licenses_key_key'
+    """)
+    has_key_constraint = cur.fetchone() is not None
+    changed = False
+    
+    # Старый отдельный индекс по key дублировал индекс ограничения UNIQUE
+    if 'idx_licenses_key' in indexes:
+        cur.execute("DROP INDEX idx_licenses_key")
+        changed = True
+    for name, ddl in (
+        ('idx_licenses_device', "CREATE INDEX idx_licenses_device ON licenses(device_id)"),
+        ('idx_licenses_created', "CREATE INDEX idx_licenses_created ON licenses(created_at)"),
+        # LIKE 'префикс%' использует индекс только с text_pattern_ops (при не-C collation)
+        ('idx_licenses_key_pattern', "CREATE INDEX idx_licenses_key_pattern ON licenses(key text_pattern_ops)"),
+    ):
+        if name not in indexes:
+            cur.execute(ddl)
+            changed = True
+    
+    # Покрывающий индекс: проверка ключа читает только индекс, без обращения к таблице.
+    # INCLUDE появился в PostgreSQL 11 - на старых версиях остается ограничение UNIQUE
+    if 'idx_licenses_key_cover' not in indexes and cur.connection.server_version >= 110000:
+        cur.execute("""
+            CREATE UNIQUE INDEX idx_licenses_key_cover
+            ON licenses(key) INCLUDE (status, expires_at, device_id)
+        """)
+        indexes['idx_licenses_key_cover'] = True
+        changed = True
+    # Уникальность key передается покрывающему индексу, только когда он точно есть,
+    # уникален и валиден - иначе каждая запись обновляла бы два одинаковых btree по key
+    if has_key_constraint and indexes.get('idx_licenses_key_cover'):
+        cur.execute("ALTER TABLE licenses DROP CONSTRAINT licenses_key_key")
+        changed = True
+    
+    if changed:
+        # Статистика для планировщика сразу после новых индексов, не дожидаясь autovacuum
+        cur.execute("ANALYZE licenses")
+        logger.info("Индексы licenses обновлены")
+
 def init_database():
     """Инициализация БД"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Не удалось подключиться к БД при инициализации")
-            return False
-        
-        try:
-            cur = conn.cursor()
-            
+        with db_cursor() as cur:
             if USE_SQLITE:
+                # WAL: читатели не ждут писателей. Режим сохраняется в файле БД,
+                # поэтому переключаем его один раз при старте, а не на каждом подключении
+                cur.execute('PRAGMA journal_mode=WAL;')
                 # SQLite синтаксис
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS licenses (
@@ -201,102 +1212,162 @@ def init_database():
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_key ON licenses(key)")
+                # key UNIQUE уже индексирован ограничением; второй индекс по key
+                # только удваивал работу каждой записи
+                cur.execute("DROP INDEX IF EXISTS idx_licenses_key")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_device ON licenses(device_id)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_created ON licenses(created_at)")
+                # Обновляет статистику планировщика, если она устарела
+                cur.execute("PRAGMA optimize")
             else:
-                # PostgreSQL синтаксис
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS licenses (
-                        id SERIAL PRIMARY KEY,
-                        key VARCHAR(50) UNIQUE NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        expires_at TIMESTAMP,
-                        device_id VARCHAR(64),
-                        device_info JSONB,
-                        activated_at TIMESTAMP,
-                        status VARCHAR(20) DEFAULT 'active',
-                        last_check TIMESTAMP,
-                        heartbeat_last TIMESTAMP
-                    )
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS license_logs (
-                        id SERIAL PRIMARY KEY,
-                        license_key VARCHAR(50),
-                        action VARCHAR(50),
-                        device_id VARCHAR(64),
-                        ip_address VARCHAR(45),
-                        user_agent TEXT,
-                        message TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_key ON licenses(key)")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_licenses_device ON licenses(device_id)")
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-            logger.info("БД успешно инициализирована")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка выполнения SQL при инициализации БД: {e}")
-            if conn:
+                # Одновременный старт нескольких процессов (воркеры, холодные старты
+                # Vercel): CREATE TABLE IF NOT EXISTS и миграция индексов не атомарны,
+                # поэтому схему создает один процесс, остальные ждут и видят готовую
+                cur.execute("SELECT pg_advisory_lock(hashtext('licenses_schema'))")
                 try:
-                    conn.close()
-                except:
-                    pass
-            return False
+                    # PostgreSQL синтаксис
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS licenses (
+                            id SERIAL PRIMARY KEY,
+                            key VARCHAR(50) UNIQUE NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            expires_at TIMESTAMP,
+                            device_id VARCHAR(64),
+                            device_info JSONB,
+                            activated_at TIMESTAMP,
+                            status VARCHAR(20) DEFAULT 'active',
+                            last_check TIMESTAMP,
+                            heartbeat_last TIMESTAMP
+                        )
+                    """)
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS license_logs (
+                            id SERIAL PRIMARY KEY,
+                            license_key VARCHAR(50),
+                            action VARCHAR(50),
+                            device_id VARCHAR(64),
+                            ip_address VARCHAR(45),
+                            user_agent TEXT,
+                            message TEXT,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    """)
+                    _migrate_pg_indexes(cur)
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(hashtext('licenses_schema'))")
+        logger.info("БД успешно инициализирована")
+        return True
+    except ConnectionError:
+        logger.error("Не удалось подключиться к БД при инициализации")
+        return False
     except Exception as e:
-        logger.error(f"Ошибка инициализации БД: {e}")
+        logger.error("Ошибка выполнения SQL при инициализации БД: %s", e)
         return False
 
+# Поля запроса, которые не входят в подпись
+UNSIGNED_FIELDS = frozenset(('signature', 'timestamp', 'nonce'))
+
+# Формат обязан байт в байт совпадать с json.dumps(..., sort_keys=True) клиента,
+# поэтому разделители и экранирование stdlib не меняем. Готовый энкодер избавляет
+# от создания JSONEncoder на каждый вызов json.dumps с нестандартными опциями.
+_CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True)
+
+def canonical_payload(data):
+    """Подписываемая часть запроса в каноническом JSON (формат совпадает с клиентом)"""
+    return _CANONICAL_ENCODER.encode({k: v for k, v in data.items() if k not in UNSIGNED_FIELDS})
+
 def verify_signature(data, signature):
     """Проверка подписи запроса"""
-    data_copy = data.copy()
-    data_copy.pop('signature', None)
-    data_copy.pop('timestamp', None)
-    data_copy.pop('nonce', None)
-    data_str = json.dumps(data_copy, sort_keys=True)
-    hash1 = hashlib.sha256((data_str + SECRET_KEY).encode()).hexdigest()
-    expected_signature = hashlib.sha256((hash1 + SECRET_KEY).encode()).hexdigest()
-    return expected_signature == signature
+    return verify_payload_signature(canonical_payload(data), signature)
+
+def verify_payload_signature(payload, signature):
+    """Проверка подписи по уже сериализованному payload"""
+    if not isinstance(signature, str):
+        return False
+    return _signature_matches(payload, signature)
+
+# Подпись v2: keyed BLAKE2b с префиксом "b2:" или HMAC-SHA256 с префиксом "hs:" -
+# один проход хэша вместо двух SHA256. Подпись без префикса (двойной SHA256)
+# принимается для старых клиентов.
+SIGNATURE_B2_PREFIX = 'b2:'
+SIGNATURE_HMAC_PREFIX = 'hs:'
+_B2_KEY = SECRET_KEY.encode()[:64]  # BLAKE2b принимает ключ не длиннее 64 байт
+_SECRET_BYTES = SECRET_KEY.encode()
+# Ключ keyed BLAKE2b и HMAC обрабатывается отдельным блоком до данных; заготовки
+# с уже поглощенным ключом копируются на каждую проверку вместо повторной обработки
+_B2_PROTO = hashlib.blake2b(key=_B2_KEY, digest_size=32)
+_HMAC_PROTO = hmac.new(_SECRET_BYTES, digestmod=hashlib.sha256)
+
+# Клиенты шлют heartbeat с одним и тем же payload (timestamp в подпись не входит),
+# поэтому вердикт кэшируем и не пересчитываем хэш на каждый запрос.
+# Защиту от повторов обеспечивает check_timestamp, который вызывается раньше.
+# Размер кэша - примерно число активных клиентов на процесс.
+SIGNATURE_CACHE_SIZE = int(os.getenv('SIGNATURE_CACHE_SIZE', '10000'))
+
+@lru_cache(maxsize=SIGNATURE_CACHE_SIZE)
+def _signature_matches(data_str, signature):
+    """Сверка подписи с каноническим JSON запроса"""
+    data = data_str.encode()
+    if signature.startswith(SIGNATURE_B2_PREFIX):
+        h = _B2_PROTO.copy()
+        h.update(data)
+        expected = h.hexdigest()
+        return hmac.compare_digest(expected.encode(), signature[len(SIGNATURE_B2_PREFIX):].encode())
+    if signature.startswith(SIGNATURE_HMAC_PREFIX):
+        h = _HMAC_PROTO.copy()
+        h.update(data)
+        expected = h.hexdigest()
+        return hmac.compare_digest(expected.encode(), signature[len(SIGNATURE_HMAC_PREFIX):].encode())
+    hash1 = hashlib.sha256(data + _SECRET_BYTES).hexdigest()
+    expected_signature = hashlib.sha256(hash1.encode() + _SECRET_BYTES).hexdigest()
+    # Сравнение за постоянное время: по времени ответа нельзя подбирать подпись
+    return hmac.compare_digest(expected_signature.encode(), signature.encode())
 
 def check_timestamp(timestamp):
     """Проверка временной метки"""
-    current_time = int(datetime.now().timestamp())
-    return abs(current_time - timestamp) < 300
+    # Строка или null из JSON - просто неверная метка, а не TypeError в горячем пути
+    if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+        return False
+    return abs(time.time() - timestamp) < 300
 
-def check_ip_whitelist():
-    """Проверка IP в whitelist"""
-    # Если whitelist отключен, разрешаем всем
-    if not ADMIN_WHITELIST_ENABLED:
-        return True
+def _client_ip():
+    """IP клиента с учетом заголовков прокси (важно для Vercel).
     
-    # Если whitelist пуст, разрешаем всем
-    if not ADMIN_WHITELIST:
-        return True
+    Вычисляется один раз за запрос и запоминается в g. Из списков адресов
+    нужен только первый, поэтому partition вместо split.
+    """
+    client_ip = g.get('client_ip')
+    if client_ip is not None:
+        return client_ip
     
+    headers = request.headers
     client_ip = request.remote_addr
-    # Проверяем также через заголовки прокси (важно для Vercel)
-    forwarded_for = request.headers.get('X-Forwarded-For')
+    forwarded_for = headers.get('X-Forwarded-For')
     if forwarded_for:
-        client_ip = forwarded_for.split(',')[0].strip()
+        client_ip = forwarded_for.partition(',')[0].strip()
     
-    real_ip = request.headers.get('X-Real-IP')
+    real_ip = headers.get('X-Real-IP')
     if real_ip:
         client_ip = real_ip
     
     # Проверяем Vercel заголовки
-    vercel_ip = request.headers.get('X-Vercel-Forwarded-For')
+    vercel_ip = headers.get('X-Vercel-Forwarded-For')
     if vercel_ip:
-        client_ip = vercel_ip.split(',')[0].strip()
+        client_ip = vercel_ip.partition(',')[0].strip()
     
-    # Нормализуем IP (убираем порт если есть)
-    if ':' in client_ip and not client_ip.startswith('['):
-        client_ip = client_ip.split(':')[0]
+    # Нормализуем IP (убираем порт у IPv4; в IPv6 двоеточий несколько)
+    if client_ip and client_ip.count(':') == 1:
+        client_ip = client_ip.partition(':')[0]
     
-    return client_ip in ADMIN_WHITELIST or any(ip.strip() in ADMIN_WHITELIST for ip in [client_ip])
+    g.client_ip = client_ip = client_ip or ''
+    return client_ip
+
+def check_ip_whitelist():
+    """Проверка IP в whitelist"""
+    # Если whitelist отключен или пуст, разрешаем всем
+    if not ADMIN_WHITELIST_ENABLED or not ADMIN_WHITELIST:
+        return True
+    return _client_ip() in ADMIN_WHITELIST
 
 def require_login(f):
     """Декоратор для проверки авторизации и IP whitelist"""
@@ -307,11 +1378,11 @@ def require_login(f):
             client_ip = request.remote_addr
             forwarded_for = request.headers.get('X-Forwarded-For', '')
             real_ip = request.headers.get('X-Real-IP', '')
-            logger.warning(f"Доступ запрещен. IP: {client_ip}, X-Forwarded-For: {forwarded_for}, X-Real-IP: {real_ip}, Whitelist: {ADMIN_WHITELIST}")
+            logger.warning("Доступ запрещен. IP: %s, X-Forwarded-For: %s, X-Real-IP: %s, Whitelist: %s", client_ip, forwarded_for, real_ip, ADMIN_WHITELIST)
             return jsonify({"error": "Доступ запрещен", "ip": client_ip}), 403
         
         if 'admin_logged_in' not in session:
-            return redirect(url_for('login'))
+            return redirect(url_for('admin.login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -868,10 +1939,12 @@ ADMIN_HTML = """
         <div class="card">
             <h2>📋 Список лицензий</h2>
             <div id="statsContainer"></div>
-            <div style="display: flex; justify-content: flex-end; margin-bottom: 20px;">
+            <div class="search-row">
+                <input type="text" id="searchInput" placeholder="Поиск по началу ключа, например TS-1A2B" autocomplete="off">
                 <button onclick="loadLicenses()" class="btn btn-secondary">↻ Обновить</button>
             </div>
             <div id="licensesTable"></div>
+            <div id="pagination"></div>
         </div>
     </div>
     
@@ -916,8 +1989,14 @@ ADMIN_HTML = """
             });
         }
 
+        let currentPage = 1;
+        const PAGE_SIZE = 100;
+
         function loadLicenses() {
-            fetch('/api/licenses')
+            const search = document.getElementById('searchInput').value.trim();
+            let url = '/api/licenses?page=' + currentPage + '&size=' + PAGE_SIZE;
+            if (search) url += '&search=' + encodeURIComponent(search);
+            fetch(url)
             .then(r => {
                 if (!r.ok) {
                     throw new Error('HTTP ' + r.status);
@@ -926,7 +2005,14 @@ ADMIN_HTML = """
             })
             .then(data => {
                 if (data.success) {
-                    updateStats(data.licenses);
+                    // Страница опустела (например, после удаления) - переходим на последнюю
+                    if (data.licenses.length === 0 && currentPage > data.pages) {
+                        currentPage = data.pages;
+                        loadLicenses();
+                        return;
+                    }
+                    updateStats(data.stats);
+                    renderPagination(data.page, data.pages);
                     
                     if (data.licenses.length === 0) {
                         document.getElementById('licensesTable').innerHTML = '<div class="empty-state"><div style="font-size: 48px; margin-bottom: 16px;">📭</div><p>Нет лицензий</p></div>';
@@ -970,15 +2056,26 @@ ADMIN_HTML = """
             });
         }
         
-        function updateStats(licenses) {
-            const stats = {
-                total: licenses.length,
-                active: licenses.filter(l => l.status === 'active').length,
-                blocked: licenses.filter(l => l.status === 'blocked').length,
-                expired: licenses.filter(l => l.status === 'expired').length,
-                activated: licenses.filter(l => l.device_id).length
-            };
-            
+        function renderPagination(page, pages) {
+            const container = document.getElementById('pagination');
+            if (pages <= 1) {
+                container.innerHTML = '';
+                return;
+            }
+            container.innerHTML =
+                '<div style="display: flex; justify-content: center; align-items: center; gap: 12px; margin-top: 20px;">' +
+                '<button class="btn btn-secondary btn-small" onclick="goToPage(' + (page - 1) + ')"' + (page <= 1 ? ' disabled' : '') + '>← Назад</button>' +
+                '<span style="color: #71717a; font-size: 13px;">Страница ' + page + ' из ' + pages + '</span>' +
+                '<button class="btn btn-secondary btn-small" onclick="goToPage(' + (page + 1) + ')"' + (page >= pages ? ' disabled' : '') + '>Вперёд →</button>' +
+                '</div>';
+        }
+
+        function goToPage(page) {
+            currentPage = Math.max(page, 1);
+            loadLicenses();
+        }
+        
+        function updateStats(stats) {
             document.getElementById('statsContainer').innerHTML = 
                 '<div class="stats">' +
                 '<div class="stat-card total"><div class="stat-value">' + stats.total + '</div><div class="stat-label">Всего</div></div>' +
@@ -1112,6 +2209,16 @@ ADMIN_HTML = """
             generateKey();
         });
 
+        // Поиск с задержкой, чтобы не слать запрос на каждую нажатую клавишу
+        let searchTimer = null;
+        document.getElementById('searchInput').addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(function() {
+                currentPage = 1;
+                loadLicenses();
+            }, 300);
+        });
+
 
         // Загружаем при загрузке страницы
         loadLicenses();
@@ -1128,13 +2235,33 @@ ADMIN_HTML = """
 </html>
 """
 
-@app.route('/')
+# Шаблон входа компилируется один раз при загрузке модуля, а не на каждый запрос.
+# ADMIN_HTML переменных не содержит и отдается как есть.
+LOGIN_TEMPLATE = Environment(autoescape=True).from_string(LOGIN_HTML)
+ADMIN_HTML_BYTES = ADMIN_HTML.encode()
+ADMIN_HTML_ETAG = hashlib.sha256(ADMIN_HTML_BYTES).hexdigest()[:32]
+# Сжатый вариант готовим один раз при импорте: страница не меняется до рестарта
+ADMIN_HTML_GZIP = gzip.compress(ADMIN_HTML_BYTES, 9)
+ADMIN_HTML_GZIP_ETAG = ADMIN_HTML_ETAG + '-gz'
+
+@admin_bp.route('/')
 @require_login
 def index():
     """Главная страница админ-панели"""
-    return render_template_string(ADMIN_HTML)
+    if request.accept_encodings['gzip']:
+        response = current_app.response_class(ADMIN_HTML_GZIP, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(ADMIN_HTML_GZIP_ETAG)
+    else:
+        response = current_app.response_class(ADMIN_HTML_BYTES, mimetype='text/html')
+        response.set_etag(ADMIN_HTML_ETAG)
+    response.vary.add('Accept-Encoding')
+    # private - страница только для вошедшего админа, общим кэшам ее хранить нельзя;
+    # no-cache - браузер каждый раз сверяет ETag и при совпадении получает пустой 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
-@app.route('/login', methods=['GET', 'POST'])
+@admin_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Страница входа"""
     # Проверка IP whitelist
@@ -1142,40 +2269,33 @@ def login():
         client_ip = request.remote_addr
         forwarded_for = request.headers.get('X-Forwarded-For', '')
         real_ip = request.headers.get('X-Real-IP', '')
-        logger.warning(f"Попытка входа с запрещенного IP: {client_ip}, X-Forwarded-For: {forwarded_for}, X-Real-IP: {real_ip}, Whitelist: {ADMIN_WHITELIST}")
+        logger.warning("Попытка входа с запрещенного IP: %s, X-Forwarded-For: %s, X-Real-IP: %s, Whitelist: %s", client_ip, forwarded_for, real_ip, ADMIN_WHITELIST)
         return jsonify({"error": "Доступ запрещен. Ваш IP не в whitelist", "ip": client_ip}), 403
     
-    # Получаем IP клиента
-    client_ip = request.remote_addr
-    forwarded_for = request.headers.get('X-Forwarded-For')
-    if forwarded_for:
-        client_ip = forwarded_for.split(',')[0].strip()
-    real_ip = request.headers.get('X-Real-IP')
-    if real_ip:
-        client_ip = real_ip
+    client_ip = _client_ip()
     
     if request.method == 'POST':
         password = request.form.get('password')
         if password == ADMIN_PASSWORD:
             session['admin_logged_in'] = True
-            return redirect(url_for('index'))
+            return redirect(url_for('admin.index'))
         else:
-            return render_template_string(LOGIN_HTML, error='Неверный пароль', client_ip=client_ip)
-    return render_template_string(LOGIN_HTML, client_ip=client_ip)
+            return LOGIN_TEMPLATE.render(error='Неверный пароль', client_ip=client_ip)
+    return LOGIN_TEMPLATE.render(client_ip=client_ip)
 
-@app.route('/logout')
+@admin_bp.route('/logout')
 def logout():
     """Выход"""
     session.pop('admin_logged_in', None)
-    return redirect(url_for('login'))
+    return redirect(url_for('admin.login'))
 
 # API endpoints для веб-интерфейса
-@app.route('/api/generate', methods=['POST'])
+@admin_bp.route('/api/generate', methods=['POST'])
 @require_login
 def api_generate():
     """Генерация ключа через веб-интерфейс"""
     try:
-        data = request.json
+        data = load_json_body() or {}
         days = data.get('days')
         
         key = f"TS-{secrets.token_hex(8).upper()}"
@@ -1183,224 +2303,134 @@ def api_generate():
         if days:
             expires_at = datetime.now() + timedelta(days=days)
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = conn.cursor()
-        if USE_SQLITE:
-            execute_query(cur, """
-                INSERT INTO licenses (key, expires_at, status)
-                VALUES (?, ?, 'active')
-            """, (key, expires_at.isoformat() if expires_at else None))
-        else:
-            execute_query(cur, """
-                INSERT INTO licenses (key, expires_at, status)
-                VALUES (%s, %s, 'active')
-            """, (key, expires_at))
-        conn.commit()
-        
-        # Проверяем, что ключ действительно сохранился
-        if USE_SQLITE:
-            cur.execute("SELECT * FROM licenses WHERE key = ?", (key,))
-        else:
-            cur.execute("SELECT * FROM licenses WHERE key = %s", (key,))
-        saved = cur.fetchone()
+        # submit возвращается после commit; ошибка записи уходит в except как раньше
+        LICENSE_INSERT_WRITER.submit(key, (key, db_datetime(expires_at)))
         
-        cur.close()
-        conn.close()
-        
-        if not saved:
-            logger.error(f"Ключ {key} не был сохранен в БД!")
-            return jsonify({"success": False, "message": "Ошибка сохранения ключа"}), 500
-        
-        logger.info(f"Ключ {key} успешно создан и сохранен")
+        logger.info("Ключ %s успешно создан и сохранен", key)
         return jsonify({"success": True, "key": key}), 200
     except Exception as e:
-        logger.error(f"Ошибка генерации: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка генерации", e)
 
-@app.route('/api/licenses')
+@admin_bp.route('/api/licenses')
 @require_login
 def api_licenses():
     """Получение списка лицензий"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        # Всегда загружаем все ключи, отсортированные по дате создания (новые сверху)
+        # Ключи состоят из букв, цифр и дефиса - остальное (в т.ч. символы шаблонов) отбрасываем
+        search = ''.join(ch for ch in request.args.get('search', '').upper() if ch.isalnum() or ch == '-')
+        page = max(request.args.get('page', 1, type=int), 1)
+        size = min(max(request.args.get('size', ADMIN_PAGE_SIZE, type=int), 1), ADMIN_PAGE_SIZE_MAX)
+        page_params = (size, (page - 1) * size)
+        # Ключи отсортированы по дате создания (новые сверху)
         try:
-            if USE_SQLITE:
-                cur.execute("SELECT * FROM licenses ORDER BY created_at DESC")
-            else:
-                cur.execute("SELECT * FROM licenses ORDER BY created_at DESC")
-            
-            raw_licenses = cur.fetchall()
-            logger.info(f"Загружено {len(raw_licenses)} ключей из БД")
+            with db_cursor(as_dict=False) as cur:
+                if search:
+                    pattern = search + KEY_PREFIX_WILDCARD
+                    execute_query(cur, SQL_SEARCH_LICENSES_ADMIN, (pattern,) + page_params)
+                    # Даты и device_info уже строки - остается собрать dict из кортежа
+                    licenses = fetch_dicts(cur)
+                    execute_query(cur, SQL_SEARCH_LICENSE_STATS, (pattern,))
+                else:
+                    execute_query(cur, SQL_LIST_LICENSES_ADMIN, page_params)
+                    licenses = fetch_dicts(cur)
+                    cur.execute(SQL_LICENSE_STATS)
+                # SUM по пустой выборке дает NULL
+                stats = {name: int(value or 0) for name, value in fetch_dicts(cur)[0].items()}
+            logger.info("Загружено %s ключей из БД", len(licenses))
         except Exception as e:
-            logger.error(f"Ошибка выполнения запроса: {e}")
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": f"Ошибка БД: {str(e)}"}), 500
-        licenses = []
-        # Конвертируем строки БД в обычные dict + приводим даты к строкам
-        for row in raw_licenses:
-            # Конвертируем в dict правильно
-            if USE_SQLITE:
-                lic = dict(row)
-            else:
-                lic = dict(row) if hasattr(row, 'keys') else {k: row[i] for i, k in enumerate(['id', 'key', 'status', 'device_id', 'device_info', 'created_at', 'activated_at', 'expires_at', 'last_check', 'description'])}
-            
-            # Приводим даты к строкам
-            for field in ['created_at', 'expires_at', 'activated_at', 'last_check']:
-                val = lic.get(field)
-                if val and hasattr(val, 'isoformat'):
-                    lic[field] = val.isoformat()
-                elif val and not isinstance(val, str):
-                    lic[field] = str(val)
-            
-            # device_info может быть JSON объектом
-            if lic.get('device_info') and not isinstance(lic['device_info'], str):
-                import json
-                try:
-                    lic['device_info'] = json.dumps(lic['device_info'])
-                except:
-                    lic['device_info'] = str(lic['device_info'])
-            
-            licenses.append(lic)
+            return server_error("success", "Ошибка выполнения запроса", e)
         
-        cur.close()
-        conn.close()
-        
-        return jsonify({"success": True, "licenses": licenses}), 200
+        return jsonify({
+            "success": True,
+            "licenses": licenses,
+            "stats": stats,
+            "page": page,
+            "size": size,
+            "pages": max((stats['total'] + size - 1) // size, 1)
+        }), 200
     except Exception as e:
-        logger.error(f"Ошибка получения лицензий: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка получения лицензий", e)
 
-@app.route('/api/block', methods=['POST'])
+@admin_bp.route('/api/block', methods=['POST'])
 @require_login
 def api_block():
     """Блокировка ключа"""
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        LICENSE_STATUS_WRITER.submit(key, ('blocked', key))
+        invalidate_license(key)
         
-        logger.info(f"Ключ {key} заблокирован")
+        logger.info("Ключ %s заблокирован", key)
         return jsonify({"success": True, "message": "Ключ заблокирован"}), 200
     except Exception as e:
-        logger.error(f"Ошибка блокировки: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка блокировки", e)
 
-@app.route('/api/unblock', methods=['POST'])
+@admin_bp.route('/api/unblock', methods=['POST'])
 @require_login
 def api_unblock():
     """Разблокировка ключа"""
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
+        LICENSE_STATUS_WRITER.submit(key, ('active', key))
+        invalidate_license(key)
         
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET status = 'active' WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET status = 'active' WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        logger.info(f"Ключ {key} разблокирован")
+        logger.info("Ключ %s разблокирован", key)
         return jsonify({"success": True, "message": "Ключ разблокирован"}), 200
     except Exception as e:
-        logger.error(f"Ошибка разблокировки: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка разблокировки", e)
 
-@app.route('/api/unbind', methods=['POST'])
+@admin_bp.route('/api/unbind', methods=['POST'])
 @require_login
 def api_unbind():
     """Отвязка устройства от ключа"""
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
+        with db_cursor() as cur:
+            execute_query(cur, SQL_UNBIND_LICENSE, (key,))
+        invalidate_license(key)
         
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET device_id = NULL, device_info = NULL, activated_at = NULL WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET device_id = NULL, device_info = NULL, activated_at = NULL WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        logger.info(f"Устройство отвязано от ключа {key}")
+        logger.info("Устройство отвязано от ключа %s", key)
         return jsonify({"success": True, "message": "Устройство отвязано"}), 200
     except Exception as e:
-        logger.error(f"Ошибка отвязки: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка отвязки", e)
 
-@app.route('/api/delete', methods=['POST'])
+@admin_bp.route('/api/delete', methods=['POST'])
 @require_login
 def api_delete():
     """Удаление ключа"""
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "DELETE FROM licenses WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "DELETE FROM licenses WHERE key = %s", (key,))
-        conn.commit()
-        deleted = cur.rowcount
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            execute_query(cur, SQL_DELETE_LICENSE, (key,))
+            deleted = cur.rowcount
+        invalidate_license(key)
         
         if deleted > 0:
             return jsonify({"success": True, "message": "Ключ удален"}), 200
         else:
             return jsonify({"success": False, "message": "Ключ не найден"}), 404
     except Exception as e:
-        logger.error(f"Ошибка удаления ключа: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка удаления ключа", e)
 
 # API endpoints для бота (с токеном авторизации вместо сессии)
 def check_bot_token():
@@ -1409,9 +2439,9 @@ def check_bot_token():
     if auth_header.startswith('Bearer '):
         token = auth_header.replace('Bearer ', '').strip()
         # Логируем для отладки
-        logger.info(f"Проверка токена бота: получен токен длиной {len(token)}, ожидается длиной {len(ADMIN_KEY) if ADMIN_KEY else 0}")
-        logger.info(f"Получен токен (первые 20 символов): '{token[:20] if len(token) > 20 else token}'")
-        logger.info(f"Ожидается токен (первые 20 символов): '{ADMIN_KEY[:20] if ADMIN_KEY and len(ADMIN_KEY) > 20 else ADMIN_KEY if ADMIN_KEY else 'N/A'}'")
+        logger.info("Проверка токена бота: получен токен длиной %s, ожидается длиной %s", len(token), len(ADMIN_KEY) if ADMIN_KEY else 0)
+        logger.info("Получен токен (первые 20 символов): '%s'", token[:20] if len(token) > 20 else token)
+        logger.info("Ожидается токен (первые 20 символов): '%s'", ADMIN_KEY[:20] if ADMIN_KEY and len(ADMIN_KEY) > 20 else ADMIN_KEY if ADMIN_KEY else 'N/A')
         
         # Сравниваем токены
         result = token == ADMIN_KEY
@@ -1419,40 +2449,26 @@ def check_bot_token():
             # Дополнительная проверка: может быть проблема с кодировкой или пробелами
             token_bytes = token.encode('utf-8')
             admin_key_bytes = ADMIN_KEY.encode('utf-8') if ADMIN_KEY else b''
-            logger.warning(f"Токен не совпал. Получен: '{token}' (bytes: {token_bytes}), ожидается: '{ADMIN_KEY}' (bytes: {admin_key_bytes})")
-            logger.warning(f"Сравнение байтов: {token_bytes == admin_key_bytes}")
+            logger.warning("Токен не совпал. Получен: '%s' (bytes: %s), ожидается: '%s' (bytes: %s)", token, token_bytes, ADMIN_KEY, admin_key_bytes)
+            logger.warning("Сравнение байтов: %s", token_bytes == admin_key_bytes)
         else:
             logger.info("✅ Токен совпал!")
         return result
     logger.warning("Заголовок Authorization отсутствует или не начинается с 'Bearer '")
     return False
 
-@app.route('/api/bot/licenses', methods=['GET'])
+@admin_bp.route('/api/bot/licenses', methods=['GET'])
 def api_bot_licenses():
     """Получение списка лицензий для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            cur.execute("SELECT * FROM licenses ORDER BY created_at DESC")
-        else:
-            cur.execute("SELECT * FROM licenses ORDER BY created_at DESC")
-        
-        raw_licenses = cur.fetchall()
-        licenses = []
+        with db_cursor(as_dict=False) as cur:
+            cur.execute(SQL_LIST_LICENSES)
+            licenses = fetch_dicts(cur)
         
-        for row in raw_licenses:
-            if USE_SQLITE:
-                lic = dict(row)
-            else:
-                lic = dict(row) if hasattr(row, 'keys') else {k: row[i] for i, k in enumerate(['id', 'key', 'status', 'device_id', 'device_info', 'created_at', 'activated_at', 'expires_at', 'last_check', 'description'])}
-            
+        for lic in licenses:
             for field in ['created_at', 'expires_at', 'activated_at', 'last_check']:
                 val = lic.get(field)
                 if val and hasattr(val, 'isoformat'):
@@ -1462,28 +2478,22 @@ def api_bot_licenses():
             
             if lic.get('device_info') and not isinstance(lic['device_info'], str):
                 try:
-                    lic['device_info'] = json.dumps(lic['device_info'])
+                    lic['device_info'] = json_dumps(lic['device_info'])
                 except:
                     lic['device_info'] = str(lic['device_info'])
-            
-            licenses.append(lic)
-        
-        cur.close()
-        conn.close()
         
         return jsonify({"success": True, "licenses": licenses}), 200
     except Exception as e:
-        logger.error(f"Ошибка получения лицензий для бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка получения лицензий для бота", e)
 
-@app.route('/api/bot/generate', methods=['POST'])
+@admin_bp.route('/api/bot/generate', methods=['POST'])
 def api_bot_generate():
     """Генерация ключа для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        data = request.json
+        data = load_json_body() or {}
         days = data.get('days')
         
         key = f"TS-{secrets.token_hex(8).upper()}"
@@ -1491,446 +2501,501 @@ def api_bot_generate():
         if days:
             expires_at = datetime.now() + timedelta(days=days)
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = conn.cursor()
-        if USE_SQLITE:
-            execute_query(cur, """
-                INSERT INTO licenses (key, expires_at, status)
-                VALUES (?, ?, 'active')
-            """, (key, expires_at.isoformat() if expires_at else None))
-        else:
-            execute_query(cur, """
-                INSERT INTO licenses (key, expires_at, status)
-                VALUES (%s, %s, 'active')
-            """, (key, expires_at))
-        conn.commit()
-        cur.close()
-        conn.close()
+        LICENSE_INSERT_WRITER.submit(key, (key, db_datetime(expires_at)))
         
-        logger.info(f"Ключ {key} создан через бота")
+        logger.info("Ключ %s создан через бота", key)
         return jsonify({"success": True, "key": key}), 200
     except Exception as e:
-        logger.error(f"Ошибка генерации для бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка генерации для бота", e)
 
-@app.route('/api/bot/block', methods=['POST'])
+@admin_bp.route('/api/bot/block', methods=['POST'])
 def api_bot_block():
     """Блокировка ключа для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        LICENSE_STATUS_WRITER.submit(key, ('blocked', key))
+        invalidate_license(key)
         
-        logger.info(f"Ключ {key} заблокирован через бота")
+        logger.info("Ключ %s заблокирован через бота", key)
         return jsonify({"success": True, "message": "Ключ заблокирован"}), 200
     except Exception as e:
-        logger.error(f"Ошибка блокировки через бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка блокировки через бота", e)
 
-@app.route('/api/bot/unblock', methods=['POST'])
+@admin_bp.route('/api/bot/unblock', methods=['POST'])
 def api_bot_unblock():
     """Разблокировка ключа для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
+        LICENSE_STATUS_WRITER.submit(key, ('active', key))
+        invalidate_license(key)
         
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET status = 'active' WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET status = 'active' WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        logger.info(f"Ключ {key} разблокирован через бота")
+        logger.info("Ключ %s разблокирован через бота", key)
         return jsonify({"success": True, "message": "Ключ разблокирован"}), 200
     except Exception as e:
-        logger.error(f"Ошибка разблокировки через бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка разблокировки через бота", e)
 
-@app.route('/api/bot/unbind', methods=['POST'])
+@admin_bp.route('/api/bot/unbind', methods=['POST'])
 def api_bot_unbind():
     """Отвязка устройства для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET device_id = NULL, device_info = NULL, activated_at = NULL WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET device_id = NULL, device_info = NULL, activated_at = NULL WHERE key = %s", (key,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            execute_query(cur, SQL_UNBIND_LICENSE, (key,))
+        invalidate_license(key)
         
-        logger.info(f"Устройство отвязано от ключа {key} через бота")
+        logger.info("Устройство отвязано от ключа %s через бота", key)
         return jsonify({"success": True, "message": "Устройство отвязано"}), 200
     except Exception as e:
-        logger.error(f"Ошибка отвязки через бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка отвязки через бота", e)
 
-@app.route('/api/bot/delete', methods=['POST'])
+@admin_bp.route('/api/bot/delete', methods=['POST'])
 def api_bot_delete():
     """Удаление ключа для бота (с токеном)"""
     if not check_bot_token():
         return jsonify({"success": False, "message": "Неверный токен авторизации"}), 401
     
     try:
-        data = request.json
+        data = load_json_body() or {}
         key = data.get('key')
         
         if not key:
             return jsonify({"success": False, "message": "Ключ не указан"}), 400
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "DELETE FROM licenses WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "DELETE FROM licenses WHERE key = %s", (key,))
-        conn.commit()
-        deleted = cur.rowcount
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            execute_query(cur, SQL_DELETE_LICENSE, (key,))
+            deleted = cur.rowcount
+        invalidate_license(key)
         
         if deleted > 0:
-            logger.info(f"Ключ {key} удален через бота")
+            logger.info("Ключ %s удален через бота", key)
             return jsonify({"success": True, "message": "Ключ удален"}), 200
         else:
             return jsonify({"success": False, "message": "Ключ не найден"}), 404
     except Exception as e:
-        logger.error(f"Ошибка удаления через бота: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return server_error("success", "Ошибка удаления через бота", e)
+
+# Частые ответы клиентского API сериализуются один раз при загрузке модуля
+_OK_BODY = json_dumps({"success": True}).encode()
+_AUTH_ERROR_BODIES = {
+    (field, message): json_dumps({field: False, "message": message}).encode()
+    for field in ('valid', 'success')
+    for message in (
+        "Пустой запрос", "Устаревший запрос", "Неверная подпись", "Ключ не указан",
+        "Слишком много запросов",
+    )
+}
+
+def _auth_error(result_field, message, status):
+    return json_response(_AUTH_ERROR_BODIES[(result_field, message)], status)
+
+# Лимит и бан ниже считаются по request.remote_addr. Без TRUSTED_PROXY_HOPS за nginx
+# или балансировщиком это адрес прокси - все клиенты делили бы один счетчик, и один
+# сбойный клиент блокировал бы остальных. Поэтому по умолчанию они включены только
+# при заданном числе прокси; без прокси их включают явно (CLIENT_RATE_LIMIT, BAD_SIGNATURE_LIMIT)
+_PER_CLIENT_IP = bool(TRUSTED_PROXY_HOPS)
+
+# Ограничение частоты запросов клиентского API с одного IP (0 - без ограничения).
+# Запас burst рассчитан на несколько устройств за одним NAT
+CLIENT_RATE_LIMIT = float(os.getenv('CLIENT_RATE_LIMIT', '10' if _PER_CLIENT_IP else '0'))
+CLIENT_RATE_BURST = float(os.getenv('CLIENT_RATE_BURST', '50'))
+_client_limiter = RateLimiter(CLIENT_RATE_LIMIT, CLIENT_RATE_BURST)
+
+# IP, приславший BAD_SIGNATURE_LIMIT неверных подписей подряд (без паузы дольше
+# BAD_SIGNATURE_WINDOW секунд), отклоняется без проверки на BAD_SIGNATURE_BAN секунд
+# (0 - без бана)
+BAD_SIGNATURE_LIMIT = int(os.getenv('BAD_SIGNATURE_LIMIT', '20' if _PER_CLIENT_IP else '0'))
+BAD_SIGNATURE_WINDOW = int(os.getenv('BAD_SIGNATURE_WINDOW', '60'))
+BAD_SIGNATURE_BAN = int(os.getenv('BAD_SIGNATURE_BAN', '300'))
+_bad_signatures = TTLCache(maxsize=100_000, ttl=BAD_SIGNATURE_WINDOW)
+_banned_ips = TTLCache(maxsize=100_000, ttl=BAD_SIGNATURE_BAN)
+
+if not _PER_CLIENT_IP and (CLIENT_RATE_LIMIT or BAD_SIGNATURE_LIMIT):
+    logger.warning(
+        "CLIENT_RATE_LIMIT/BAD_SIGNATURE_LIMIT включены при TRUSTED_PROXY_HOPS=0: лимиты считаются "
+        "по адресу соединения. Если перед приложением есть прокси или балансировщик, все клиенты "
+        "попадут в один счетчик - задайте TRUSTED_PROXY_HOPS"
+    )
+
+def _too_many_requests(result_field, retry_after):
+    response = _auth_error(result_field, "Слишком много запросов", 429)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def _authenticated_json(result_field):
+    """Тело подписанного запроса клиента: (data, None) или (None, готовый ответ с ошибкой).
+    
+    Дешевые проверки идут первыми: лимит запросов и бан по IP - до разбора тела,
+    устаревший запрос отклоняется до вычисления подписи, а до БД доходят только
+    запросы с верной подписью.
+    """
+    # Адрес соединения, а не заголовки X-Forwarded-For/X-Real-IP: их клиент задает
+    # сам и мог бы обходить лимит или подставлять чужой IP под бан. За доверенным
+    # прокси remote_addr уже исправлен ProxyFix (TRUSTED_PROXY_HOPS)
+    client_ip = request.remote_addr or ''
+    if _banned_ips.get(client_ip):
+        return None, _too_many_requests(result_field, BAD_SIGNATURE_BAN)
+    if CLIENT_RATE_LIMIT and not _client_limiter.allow(client_ip):
+        return None, _too_many_requests(result_field, 1)
+    
+    # Подписанное тело разбирается стандартным json, как и канонизируется в
+    # canonical_payload: orjson отвергает NaN/Infinity и одиночные суррогаты,
+    # а целые больше 64 бит превращает в float - подпись таких данных не сошлась бы
+    data = load_json_body(json.loads)
+    if not data or not isinstance(data, dict):
+        return None, _auth_error(result_field, "Пустой запрос", 400)
+    
+    signature = data.pop('signature', '')
+    if not check_timestamp(data.get('timestamp', 0)):
+        return None, _auth_error(result_field, "Устаревший запрос", 403)
+    
+    if not verify_signature(data, signature):
+        if BAD_SIGNATURE_LIMIT and _bad_signatures.incr(client_ip) >= BAD_SIGNATURE_LIMIT:
+            _bad_signatures.pop(client_ip)
+            _banned_ips.set(client_ip, True)
+            logger.warning("IP %s заблокирован на %d с: неверные подписи", client_ip, BAD_SIGNATURE_BAN)
+        return None, _auth_error(result_field, "Неверная подпись", 403)
+    
+    # Счет идет только по неверным подписям подряд: верная сбрасывает его
+    _bad_signatures.pop(client_ip)
+    return data, None
+
+def signed_endpoint(result_field):
+    """Декоратор эндпоинта клиента: разбор тела, метка времени, подпись и наличие ключа.
+    
+    Обработчик вызывается только для прошедших проверку запросов и получает
+    (data, key, device_id); ошибки проверки возвращаются заранее собранными ответами.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper():
+            data, error = _authenticated_json(result_field)
+            if error:
+                return error
+            key = data.get('key')
+            # Подпись верна, но key не строка (число, список) - как и в пакетной активации
+            if not key or not isinstance(key, str):
+                return _auth_error(result_field, "Ключ не указан", 400)
+            return f(data, key, data.get('device_id'))
+        return wrapper
+    return decorator
+
+@api_bp.after_request
+def _api_no_store(response):
+    """Ответы клиентского API зависят от состояния ключа - прокси и клиент их не кэшируют.
+    
+    Исключение - ответы check_license с ETag: они уже помечены private, no-cache.
+    
+    Keep-alive заголовком здесь не включается (Connection - hop-by-hop заголовок,
+    в WSGI его выставлять нельзя): соединение держит gunicorn (keepalive в
+    gunicorn.conf.py), а клиент должен переиспользовать его - один requests.Session
+    на все запросы check/heartbeat вместо нового TCP/TLS-соединения на каждый.
+    """
+    response.headers.setdefault('Cache-Control', 'no-store')
+    return response
 
 # API endpoints для клиента (БЕЗ проверки IP whitelist - доступны всем)
-@app.route('/api/v1/license/check', methods=['POST'])
-def check_license():
+@api_bp.route('/license/check', methods=['POST'])
+@signed_endpoint('valid')
+def check_license(data, key, device_id):
     """Проверка лицензии (для клиента)"""
     try:
-        data = request.json
-        if not data:
-            return jsonify({"valid": False, "message": "Пустой запрос"}), 400
-        
-        signature = data.pop('signature', '')
-        timestamp = data.get('timestamp', 0)
+        # Горячие ключи берутся из кэша: подключение к БД берется только при промахе
+        license_info = get_license(key)
         
-        if not check_timestamp(timestamp):
-            return jsonify({"valid": False, "message": "Устаревший запрос"}), 403
-        
-        if not verify_signature(data, signature):
-            return jsonify({"valid": False, "message": "Неверная подпись"}), 403
-        
-        key = data.get('key')
-        device_id = data.get('device_id')
-        
-        if not key:
-            return jsonify({"valid": False, "message": "Ключ не указан"}), 400
-        
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"valid": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        execute_query(cur, "SELECT * FROM licenses WHERE key = %s", (key,))
-        row = cur.fetchone()
-        
-        if not row:
-            cur.close()
-            conn.close()
+        if not license_info:
             return jsonify({"valid": False, "message": "Ключ не найден"}), 200
         
-        license_info = dict(row) if USE_SQLITE else row
-        
         if license_info['status'] == 'blocked':
-            cur.close()
-            conn.close()
             return jsonify({"valid": False, "message": "Ключ заблокирован"}), 200
         
-        if license_info['expires_at']:
-            expires = datetime.fromisoformat(license_info['expires_at']) if isinstance(license_info['expires_at'], str) else license_info['expires_at']
-            if datetime.now() > expires:
+        if license_info['expires_ts'] is not None:
+            if time.time() > license_info['expires_ts']:
                 # Блокируем истекший ключ автоматически
-                execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = %s", (key,))
-                conn.commit()
-                cur.close()
-                conn.close()
-                return jsonify({"valid": False, "message": "Лицензия истекла и заблокирована"}), 200
+                with db_cursor() as cur:
+                    execute_prepared(cur, 'lic_expire', ('blocked', key, db_datetime(datetime.now())))
+                    expired = cur.rowcount
+                invalidate_license(key)
+                if expired:
+                    return jsonify({"valid": False, "message": "Лицензия истекла и заблокирована"}), 200
+                # Ключ изменили после чтения (продлили или удалили)
+                return jsonify({"valid": False, "message": "Не удалось проверить ключ, повторите запрос"}), 200
         
         if license_info['device_id'] and license_info['device_id'] != device_id:
-            cur.close()
-            conn.close()
             return jsonify({"valid": False, "message": "Ключ привязан к другому устройству"}), 200
         
-        if USE_SQLITE:
-            execute_query(cur, "UPDATE licenses SET last_check = datetime('now') WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "UPDATE licenses SET last_check = CURRENT_TIMESTAMP WHERE key = %s", (key,))
-        conn.commit()
+        # last_check пишется пачкой в фоне, ответ клиенту его не ждет
+        LAST_CHECK_WRITER.add(key, (db_timestamp(), key))
         
-        cur.close()
-        conn.close()
+        # Лицензия не менялась с прошлой проверки клиента - пустой 304 вместо JSON
+        # no-store запретил бы клиенту сохранить ответ, и If-None-Match он бы не прислал:
+        # ответ с ETag можно хранить, но только на клиенте и с проверкой перед каждым использованием
+        etag = license_info['etag']
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
         
-        # Форматируем дату истечения
-        expires_str = None
-        if license_info['expires_at']:
-            try:
-                if isinstance(license_info['expires_at'], str):
-                    expires_str = license_info['expires_at']
-                else:
-                    expires_str = license_info['expires_at'].isoformat()
-            except:
-                expires_str = str(license_info['expires_at'])
-        
-        return jsonify({
+        response = jsonify({
             "valid": True,
             "message": "Лицензия активна",
-            "expires": expires_str
-        }), 200
+            "expires": license_info['expires_at']
+        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
-        logger.error(f"Ошибка проверки: {e}")
-        return jsonify({"valid": False, "message": f"Ошибка сервера: {str(e)}"}), 500
+        return server_error("valid", "Ошибка проверки", e)
 
-@app.route('/api/v1/license/activate', methods=['POST'])
-def activate_license():
+@api_bp.route('/license/activate', methods=['POST'])
+@signed_endpoint('success')
+def activate_license(data, key, device_id):
     """Активация лицензии (для клиента)"""
     try:
-        data = request.json
-        if not data:
-            return jsonify({"success": False, "message": "Пустой запрос"}), 400
-        
-        signature = data.pop('signature', '')
-        timestamp = data.get('timestamp', 0)
-        
-        if not check_timestamp(timestamp):
-            return jsonify({"success": False, "message": "Устаревший запрос"}), 403
-        
-        if not verify_signature(data, signature):
-            return jsonify({"success": False, "message": "Неверная подпись"}), 403
-        
-        key = data.get('key')
-        device_id = data.get('device_id')
         device_info = data.get('device_info')
         
-        if not key:
-            return jsonify({"success": False, "message": "Ключ не указан"}), 400
-        
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        if USE_SQLITE:
-            execute_query(cur, "SELECT * FROM licenses WHERE key = ?", (key,))
-        else:
-            execute_query(cur, "SELECT * FROM licenses WHERE key = %s", (key,))
-        row = cur.fetchone()
-        
-        if not row:
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": "Ключ не найден"}), 200
-        
-        license_info = dict(row) if USE_SQLITE else row
+        now = datetime.now()
+        with db_cursor() as cur:
+            # Все условия активации проверяет сама БД в одном UPDATE:
+            # один запрос вместо SELECT + UPDATE и без гонки между ними
+            execute_prepared(cur, 'lic_activate', (
+                device_id, db_json(device_info), db_timestamp(), key, device_id,
+                db_datetime(now)
+            ))
+            
+            if cur.rowcount == 0:
+                # Активация не прошла - читаем строку только чтобы объяснить причину
+                license_info = get_license(key, cur)
+                
+                if not license_info:
+                    return jsonify({"success": False, "message": "Ключ не найден"}), 200
+                
+                if license_info['status'] == 'blocked':
+                    return jsonify({"success": False, "message": "Ключ заблокирован"}), 200
+                
+                # Срок уже разобран в expires_ts при чтении строки - сравниваем числа
+                if license_info['expires_ts'] is not None:
+                    if now.timestamp() > license_info['expires_ts']:
+                        execute_prepared(cur, 'lic_expire', ('expired', key, db_datetime(now)))
+                        invalidate_license(key)
+                        if cur.rowcount:
+                            return jsonify({"success": False, "message": "Лицензия истекла"}), 200
+                
+                if license_info['device_id'] and license_info['device_id'] != device_id:
+                    return jsonify({"success": False, "message": "Ключ уже привязан к другому устройству"}), 200
+                
+                # Строка изменилась между UPDATE и чтением (или кэш устарел)
+                invalidate_license(key)
+                return jsonify({"success": False, "message": "Не удалось активировать ключ, повторите запрос"}), 200
+        
+        invalidate_license(key)
+        return jsonify({"success": True, "message": "Ключ активирован"}), 200
         
-        if license_info['status'] == 'blocked':
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": "Ключ заблокирован"}), 200
+    except Exception as e:
+        return server_error("success", "Ошибка активации", e)
+
+def _activation_error(license_info, device_id):
+    """Причина, по которой ключ не активировался (по уже прочитанной строке)"""
+    if not license_info:
+        return "Ключ не найден"
+    if license_info['status'] == 'blocked':
+        return "Ключ заблокирован"
+    if license_info['expires_ts'] is not None and time.time() > license_info['expires_ts']:
+        return "Лицензия истекла"
+    if license_info['device_id'] and license_info['device_id'] != device_id:
+        return "Ключ уже привязан к другому устройству"
+    return "Не удалось активировать ключ, повторите запрос"
+
+@api_bp.route('/license/activate_batch', methods=['POST'])
+def activate_license_batch():
+    """Пакетная активация (массовая установка на устройства).
+    
+    Тело: {"items": [{"key", "device_id", "device_info"}, ...], "timestamp", "signature"} -
+    одна подпись на весь пакет. Все ключи активируются в одной транзакции,
+    результат возвращается по каждому элементу в том же порядке.
+    """
+    try:
+        data, error = _authenticated_json('success')
+        if error:
+            return error
+        
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({"success": False, "message": "Пустой пакет"}), 400
+        if len(items) > ACTIVATE_BATCH_MAX:
+            return jsonify({"success": False, "message": f"Не больше {ACTIVATE_BATCH_MAX} ключей в пакете"}), 400
+        
+        results = [None] * len(items)
+        rows = []
+        seen = set()
+        activated_at = db_timestamp()
+        now = db_datetime(datetime.now())
+        for i, item in enumerate(items):
+            key = item.get('key') if isinstance(item, dict) else None
+            if not key or not isinstance(key, str):
+                results[i] = "Ключ не указан"
+            elif key in seen:
+                results[i] = "Ключ повторяется в пакете"
+            else:
+                seen.add(key)
+                rows.append((i, key, item.get('device_id'), db_json(item.get('device_info'))))
         
-        if license_info['expires_at']:
-            expires = datetime.fromisoformat(license_info['expires_at']) if isinstance(license_info['expires_at'], str) else license_info['expires_at']
-            if datetime.now() > expires:
+        activated = set()
+        with db_cursor() as cur:
+            if rows:
                 if USE_SQLITE:
-                    execute_query(cur, "UPDATE licenses SET status = 'expired' WHERE key = ?", (key,))
+                    # SQLite: UPDATE на каждый ключ, но в одной транзакции и с одним commit
+                    for _, key, device_id, device_info in rows:
+                        execute_prepared(cur, 'lic_activate', (
+                            device_id, device_info, activated_at, key, device_id, now
+                        ))
+                        if cur.rowcount:
+                            activated.add(key)
                 else:
-                    execute_query(cur, "UPDATE licenses SET status = 'expired' WHERE key = %s", (key,))
-                conn.commit()
-                cur.close()
-                conn.close()
-                return jsonify({"success": False, "message": "Лицензия истекла"}), 200
-        
-        if license_info['device_id'] and license_info['device_id'] != device_id:
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": "Ключ уже привязан к другому устройству"}), 200
-        
-        if USE_SQLITE:
-            execute_query(cur, """
-                UPDATE licenses 
-                SET device_id = ?, device_info = ?, activated_at = datetime('now'), status = 'active'
-                WHERE key = ?
-            """, (device_id, json.dumps(device_info), key))
-        else:
-            execute_query(cur, """
-                UPDATE licenses 
-                SET device_id = %s, device_info = %s, activated_at = CURRENT_TIMESTAMP, status = 'active'
-                WHERE key = %s
-            """, (device_id, json.dumps(device_info), key))
-        conn.commit()
+                    returned = execute_values(cur, SQL_ACTIVATE_BATCH_PG, [
+                        (key, device_id, device_info, activated_at, now)
+                        for _, key, device_id, device_info in rows
+                    ], page_size=ACTIVATE_BATCH_MAX, fetch=True)
+                    activated = {row[0] for row in returned}
+        
+        # Кэш сбрасываем и причины читаем после commit: иначе параллельная проверка
+        # могла бы закэшировать строку в том виде, что была до активации
+        failed = []
+        for i, key, device_id, _ in rows:
+            invalidate_license(key)
+            if key not in activated:
+                failed.append((i, key, device_id))
+        if failed:
+            with db_cursor() as cur:
+                for i, key, device_id in failed:
+                    results[i] = _activation_error(get_license(key, cur), device_id)
         
-        cur.close()
-        conn.close()
-        
-        return jsonify({"success": True, "message": "Ключ активирован"}), 200
+        return jsonify({
+            "success": True,
+            "results": [
+                {
+                    "key": item.get('key') if isinstance(item, dict) else None,
+                    "success": message is None,
+                    "message": message or "Ключ активирован",
+                }
+                for item, message in zip(items, results)
+            ],
+        }), 200
         
     except Exception as e:
-        logger.error(f"Ошибка активации: {e}")
-        return jsonify({"success": False, "message": f"Ошибка сервера: {str(e)}"}), 500
+        return server_error("success", "Ошибка пакетной активации", e)
 
-@app.route('/api/v1/license/deactivate', methods=['POST'])
-def deactivate_license():
+@api_bp.route('/license/deactivate', methods=['POST'])
+@signed_endpoint('success')
+def deactivate_license(data, key, device_id):
     """Деактивация (блокировка) лицензии"""
     try:
-        data = request.json
-        if not data:
-            return jsonify({"success": False, "message": "Пустой запрос"}), 400
-        
-        signature = data.pop('signature', '')
-        timestamp = data.get('timestamp', 0)
-        
-        if not check_timestamp(timestamp):
-            return jsonify({"success": False, "message": "Устаревший запрос"}), 403
-        
-        if not verify_signature(data, signature):
-            return jsonify({"success": False, "message": "Неверная подпись"}), 403
-        
-        key = data.get('key')
-        device_id = data.get('device_id')
-        
-        if not key:
-            return jsonify({"success": False, "message": "Ключ не указан"}), 400
-        
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
-        
-        cur = get_cursor(conn)
-        execute_query(cur, "SELECT * FROM licenses WHERE key = %s", (key,))
-        row = cur.fetchone()
-        
-        if not row:
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": "Ключ не найден"}), 200
-        
-        license_info = dict(row) if USE_SQLITE else row
-        
-        # Проверяем device_id
-        if license_info['device_id'] and license_info['device_id'] != device_id:
-            cur.close()
-            conn.close()
-            return jsonify({"success": False, "message": "Ключ привязан к другому устройству"}), 200
-        
-        # Блокируем ключ
-        execute_query(cur, "UPDATE licenses SET status = 'blocked' WHERE key = %s", (key,))
-        conn.commit()
-        
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            # Блокируем ключ, если он не привязан к другому устройству
+            execute_prepared(cur, 'lic_deactivate', (key, device_id))
+            
+            if cur.rowcount == 0:
+                if not get_license(key, cur):
+                    return jsonify({"success": False, "message": "Ключ не найден"}), 200
+                return jsonify({"success": False, "message": "Ключ привязан к другому устройству"}), 200
         
-        logger.info(f"Ключ {key} заблокирован (деактивация)")
+        invalidate_license(key)
+        logger.info("Ключ %s заблокирован (деактивация)", key)
         return jsonify({"success": True, "message": "Ключ заблокирован"}), 200
         
     except Exception as e:
-        logger.error(f"Ошибка деактивации: {e}")
-        return jsonify({"success": False, "message": f"Ошибка сервера: {str(e)}"}), 500
+        return server_error("success", "Ошибка деактивации", e)
 
-@app.route('/api/v1/license/heartbeat', methods=['POST'])
-def heartbeat():
+@api_bp.route('/license/heartbeat', methods=['POST'])
+@signed_endpoint('success')
+def heartbeat(data, key, device_id):
     """Heartbeat (для клиента)"""
     try:
-        data = request.json
-        signature = data.pop('signature', '')
-        timestamp = data.get('timestamp', 0)
+        # Запись в БД делает фоновый поток пачками
+        queue_heartbeat(key, device_id)
         
-        if not check_timestamp(timestamp):
-            return jsonify({"success": False, "message": "Устаревший запрос"}), 403
+        return json_response(_OK_BODY)
         
-        if not verify_signature(data, signature):
-            return jsonify({"success": False, "message": "Неверная подпись"}), 403
-        
-        key = data.get('key')
-        device_id = data.get('device_id')
+    except Exception as e:
+        return server_error("success", "Ошибка heartbeat", e)
+
+# Тело ответа /health пересобирается не чаще раза в секунду: эндпоинт опрашивают пробы
+_health_cache = (None, b'')
+
+def health():
+    """Проверка работоспособности"""
+    global _health_cache
+    second = int(time.time())
+    cached_second, body = _health_cache
+    if cached_second != second:
+        timestamp = datetime.fromtimestamp(second).isoformat()
+        body = json_dumps({"status": "ok", "timestamp": timestamp}).encode()
+        _health_cache = (second, body)
+    return json_response(body)
+
+if ORJSON_AVAILABLE:
+    class OrjsonProvider(DefaultJSONProvider):
+        """JSON Flask через orjson: правила DefaultJSONProvider (сортировка ключей,
+        даты в формате HTTP, Decimal и т.д.), но сериализация в C и сразу в bytes"""
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"success": False, "message": "Ошибка сервера"}), 500
+        OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
         
-        cur = conn.cursor()
-        if USE_SQLITE:
-            execute_query(cur, """
-                UPDATE licenses 
-                SET heartbeat_last = datetime('now') 
-                WHERE key = ? AND device_id = ?
-            """, (key, device_id))
-        else:
-            execute_query(cur, """
-                UPDATE licenses 
-                SET heartbeat_last = CURRENT_TIMESTAMP 
-                WHERE key = %s AND device_id = %s
-            """, (key, device_id))
-        conn.commit()
+        def _dumps_bytes(self, obj):
+            return orjson.dumps(obj, default=self.default, option=self.OPTIONS)
         
-        cur.close()
-        conn.close()
+        def dumps(self, obj, **kwargs):
+            return self._dumps_bytes(obj).decode()
         
-        return jsonify({"success": True}), 200
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
         
-    except Exception as e:
-        logger.error(f"Ошибка heartbeat: {e}")
-        return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 500
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(self._dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Проверка работоспособности"""
-    return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()}), 200
+def create_app(*blueprints):
+    """Flask-приложение с указанными blueprint'ами (по умолчанию - со всеми)"""
+    flask_app = Flask(__name__)
+    flask_app.secret_key = FLASK_SECRET_KEY
+    if ORJSON_AVAILABLE:
+        flask_app.json = OrjsonProvider(flask_app)
+    CORS(flask_app)
+    if TRUSTED_PROXY_HOPS:
+        # Берем из X-Forwarded-For ровно столько адресов, сколько прокси мы
+        # поставили сами; остальное в заголовке мог дописать клиент
+        flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+    for blueprint in blueprints or (api_bp, admin_bp):
+        flask_app.register_blueprint(blueprint)
+    flask_app.add_url_rule('/health', 'health', health, methods=['GET'])
+    return flask_app
+
+# Единое приложение (локальный запуск, Vercel)
+app = create_app()
 
 if __name__ == '__main__':
     print("=" * 60)
@@ -1947,6 +3012,31 @@ if __name__ == '__main__':
     print(f"🌐 Whitelist IP: {', '.join(ADMIN_WHITELIST) if ADMIN_WHITELIST else 'Все IP разрешены'}")
     print("\n⚠️  ИЗМЕНИТЕ ПАРОЛЬ в переменной окружения ADMIN_PASSWORD!")
     print("⚠️  Настройте ADMIN_WHITELIST для ограничения доступа!")
+    print("🚀 Продакшен: gunicorn -c gunicorn.conf.py license_web_admin:app")
+    print("   или раздельно: gunicorn -c gunicorn.conf.py api_wsgi:app")
+    print("                  gunicorn -c gunicorn.conf.py -k sync -w 2 admin_wsgi:app")
+    print("🛠  Dev-сервер Flask: DEV=1 python license_web_admin.py")
     print("=" * 60)
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    if os.getenv('DEV'):
+        app.run(host='0.0.0.0', port=5000, debug=False)
+    else:
+        # Dev-сервер Werkzeug не рассчитан на нагрузку - без DEV процесс
+        # заменяется на gunicorn с gevent-воркерами из gunicorn.conf.py
+        # (без gevent gunicorn.conf.py сам переключается на sync-воркеры)
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        gunicorn_path = shutil.which('gunicorn')
+        if gunicorn_path:
+            flush_pending_writes()
+            close_db_pool()
+            # exec не вызывает atexit: записи, еще лежащие в очереди лога, пишем сейчас
+            if not os.getenv('VERCEL'):
+                _log_listener.stop()
+            os.execv(gunicorn_path, [
+                'gunicorn', '--chdir', base_dir,
+                '-c', os.path.join(base_dir, 'gunicorn.conf.py'),
+                'license_web_admin:app',
+            ])
+        else:
+            print("⚠️  gunicorn не установлен (pip install -r requirements_server.txt), запускаю dev-сервер")
+            app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)